@@ -0,0 +1,918 @@
+import os
+import mmap
+import logging
+import random
+import struct
+import threading
+import time
+import numpy as np
+from array import array
+from bisect import bisect, bisect_left
+from itertools import accumulate
+
+# same markers as markovify, so exported chains stay compatible
+BEGIN = '___BEGIN__'
+END = '___END__'
+BEGIN_ID = 0
+END_ID = 1
+# weights closer to 0 are left by rounding when lines are erased
+ROUNDING = 1e-9
+
+class Vocabulary:
+    '''
+    Interns tokens into small integers. BEGIN and END always take 0 and 1.
+    The vocabulary may be shared by several chains.
+    '''
+    def __init__(self):
+        self.tokens = [BEGIN, END]
+        self.ids = {BEGIN: BEGIN_ID, END: END_ID}
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __getitem__(self, token_id):
+        return self.tokens[token_id]
+
+    def get(self, token, default=None):
+        return self.ids.get(token, default)
+
+    def intern(self, token):
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        return token_id
+
+class MappedVocabulary(Vocabulary):
+    '''
+    Vocabulary whose first tokens are read from a memory-mapped snapshot.
+    Tokens are looked up with a binary search over the snapshot, and new
+    tokens are interned in memory after them.
+    '''
+    def __init__(self, blob, token_offsets, token_order):
+        self.blob = blob
+        self.token_offsets = token_offsets
+        # token ids sorted by their utf-8 encoding
+        self.token_order = token_order
+        self.base_size = len(token_order)
+        self.tokens = []
+        self.ids = {}
+
+    def __len__(self):
+        return self.base_size + len(self.tokens)
+
+    def __getitem__(self, token_id):
+        if token_id >= self.base_size:
+            return self.tokens[token_id - self.base_size]
+        return self.encoded(token_id).decode('utf-8', 'surrogatepass')
+
+    def encoded(self, token_id):
+        return bytes(self.blob[self.token_offsets[token_id]:self.token_offsets[token_id+1]])
+
+    def get(self, token, default=None):
+        token_id = self.ids.get(token)
+        if token_id is not None:
+            return token_id
+        encoded = token.encode('utf-8', 'surrogatepass')
+        lo, hi = 0, self.base_size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cur = self.encoded(self.token_order[mid])
+            if cur < encoded:
+                lo = mid + 1
+            elif cur > encoded:
+                hi = mid
+            else:
+                return self.token_order[mid]
+        return default
+
+    def intern(self, token):
+        token_id = self.get(token)
+        if token_id is None:
+            token_id = self.ids[token] = len(self)
+            self.tokens.append(token)
+        return token_id
+
+class TransitionTable:
+    '''
+    Array-backed transition table, in the layout of a CSR sparse matrix.
+    The i-th state has the packed key keys[i] (keys are sorted), and its possible
+    next tokens are next_ids[offsets[i]:offsets[i+1]] (sorted by token id),
+    with the cumulative weights in cumdist at the same positions.
+    '''
+    def __init__(self, keys=None, offsets=None, next_ids=None, cumdist=None):
+        self.keys = keys if keys is not None else array('Q')
+        self.offsets = offsets if offsets is not None else array('Q', [0])
+        self.next_ids = next_ids if next_ids is not None else array('I')
+        self.cumdist = cumdist if cumdist is not None else array('d')
+        # numpy views for vectorized draws, built on first use (tables are not modified)
+        self.np_arrays = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, key, lo=0):
+        # return: state id, or -1 if not found
+        keys = self.keys
+        i = bisect_left(keys, key, lo)
+        if i < len(keys) and keys[i] == key:
+            return i
+        return -1
+
+    def slice(self, state_id):
+        return self.offsets[state_id], self.offsets[state_id+1]
+
+    def successors(self, state_id):
+        # return: (next token ids, cumulative weights)
+        a, b = self.slice(state_id)
+        return self.next_ids[a:b], self.cumdist[a:b]
+
+    def weights(self, state_id):
+        # return: dict of next token id -> weight
+        a, b = self.slice(state_id)
+        cumdist = self.cumdist
+        rst = {}
+        prev = 0.
+        for i in range(a, b):
+            rst[self.next_ids[i]] = cumdist[i] - prev
+            prev = cumdist[i]
+        return rst
+
+    def weight(self, state_id, token_id):
+        a, b = self.slice(state_id)
+        i = bisect_left(self.next_ids, token_id, a, b)
+        if i == b or self.next_ids[i] != token_id:
+            return 0.
+        return self.cumdist[i] - (self.cumdist[i-1] if i > a else 0.)
+
+    def arrays(self):
+        # return: numpy views of (keys, offsets, next ids, cumulative weights), nothing is copied
+        if self.np_arrays is None:
+            # offsets are far below 2**63
+            self.np_arrays = (np.frombuffer(self.keys, dtype=np.uint64), np.frombuffer(self.offsets, dtype=np.int64),
+                np.frombuffer(self.next_ids, dtype=np.uint32), np.frombuffer(self.cumdist, dtype=np.float64))
+        return self.np_arrays
+
+    def nbytes(self):
+        return sum(len(arr) * arr.itemsize for arr in (self.keys, self.offsets, self.next_ids, self.cumdist))
+
+class StateIndex:
+    '''
+    Inverted index of a transition table: for each token, the keys of the states
+    having that token at any position but the last one, grouped by token id.
+    (States are already grouped by their last token in the table itself.)
+    '''
+    def __init__(self, offsets=None, keys=None):
+        self.offsets = offsets if offsets is not None else array('Q', [0])
+        self.keys = keys if keys is not None else array('Q')
+
+    @classmethod
+    def build(cls, table, state_size, n_tokens):
+        bits = 64 // state_size
+        keys = np.frombuffer(table.keys, dtype=np.uint64)
+        mask = np.uint64((1 << bits) - 1)
+        token_ids = np.concatenate([(keys >> np.uint64(bits * i)) & mask for i in range(state_size - 1)])
+        order = np.argsort(token_ids, kind='stable')
+        index_keys = np.tile(keys, state_size - 1)[order]
+        offsets = np.searchsorted(token_ids[order], np.arange(n_tokens + 1, dtype=np.uint64))
+        return cls(array('Q', offsets.astype(np.uint64).tobytes()), array('Q', index_keys.tobytes()))
+
+    def get(self, token_id):
+        if token_id + 1 >= len(self.offsets):
+            return ()
+        return self.keys[self.offsets[token_id]:self.offsets[token_id+1]]
+
+    def nbytes(self):
+        return len(self.offsets) * self.offsets.itemsize + len(self.keys) * self.keys.itemsize
+
+def has_residual(succ):
+    # whether a successor dict has transitions erased more than fed
+    return any(w < -ROUNDING for w in succ.values())
+
+def merge_table(table, delta, state_size, n_tokens):
+    '''
+    Build a table from `table` with the states in `delta` replaced, and its index.
+    Transitions of weight <= 0 are dropped, and so are states left without any.
+    States with a negative residual are not merged, so that feeding the erased
+    lines again cancels it. Neither argument is modified, so that it can run in
+    another thread.
+    delta: {key: {next token id: weight}}
+    return: (table, index, keys of the states left in delta)
+    '''
+    keys = np.fromiter(delta, dtype=np.uint64, count=len(delta))
+    keys.sort()
+    d_keys = []
+    residual = []
+    d_counts = []
+    d_next_ids = array('I')
+    d_cumdist = array('d')
+    for key in keys.tolist():
+        succ = delta[key]
+        if has_residual(succ):
+            residual.append(key)
+            continue
+        d_keys.append(key)
+        token_ids = sorted(t for t, w in succ.items() if w > 0)
+        d_counts.append(len(token_ids))
+        d_next_ids.extend(token_ids)
+        d_cumdist.extend(accumulate(succ[t] for t in token_ids))
+    d_keys = np.array(d_keys, dtype=np.uint64)
+    d_counts = np.array(d_counts, dtype=np.int64)
+    keys = np.frombuffer(table.keys, dtype=np.uint64)
+    offsets = np.frombuffer(table.offsets, dtype=np.uint64).astype(np.int64)
+    # states of the table not replaced, and the ones of delta still having successors
+    keep = ~np.isin(keys, d_keys, assume_unique=True)
+    live = d_counts > 0
+    new_keys = np.concatenate([keys[keep], d_keys[live]])
+    # start of their transitions in the table's arrays followed by delta's
+    starts = np.concatenate([offsets[:-1][keep], len(table.next_ids) + (np.cumsum(d_counts) - d_counts)[live]])
+    counts = np.concatenate([np.diff(offsets)[keep], d_counts[live]])
+    order = np.argsort(new_keys, kind='stable')
+    new_keys, starts, counts = new_keys[order], starts[order], counts[order]
+    new_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=new_offsets[1:])
+    src = np.repeat(starts - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+    next_ids = np.concatenate([np.frombuffer(table.next_ids, dtype=np.uint32),
+        np.frombuffer(d_next_ids, dtype=np.uint32)])[src]
+    cumdist = np.concatenate([np.frombuffer(table.cumdist, dtype=np.float64),
+        np.frombuffer(d_cumdist, dtype=np.float64)])[src]
+    new = TransitionTable(array('Q', new_keys.tobytes()), array('Q', new_offsets.astype(np.uint64).tobytes()),
+        array('I', next_ids.tobytes()), array('d', cumdist.tobytes()))
+    return new, StateIndex.build(new, state_size, n_tokens), residual
+
+class PendingMerge:
+    '''
+    A merge in progress in another thread, of a copy of delta into `table`,
+    with the delta indexes of the states changed since, valid once it's done.
+    '''
+    def __init__(self, table, delta):
+        self.table = table
+        self.delta = delta
+        self.thread = None
+        # (table, index, residual keys), set by the thread if it succeeds
+        self.result = None
+        self.changed = set()
+        self.delta_prefix = {}
+        self.delta_index = {}
+        self.new_states = 0
+
+class MarkovChain:
+    '''
+    Markov chain over interned tokens.
+
+    A state of `state_size` token ids is packed into one 64-bit key, with the
+    first token in the lowest bits. Thus the keys in the table are grouped by
+    the *last* token of the state, and the predecessors of a state can be found
+    with a binary search instead of a full scan.
+
+    Feeding and erasing go to `delta`, a small dict holding the full successor
+    weights of the states changed since the last merge. It is merged into the
+    compact table once it holds more than len(table) / merge_ratio states.
+    States erased more than they were fed stay in delta with negative weights,
+    until they are fed again, so that weights add up like in markovify.
+    A merge costs O(len(delta)) in Python and O(len(table)) array copies in numpy,
+    so a changed state costs O(merge_ratio) copies amortized. The change which
+    triggers a merge waits for all of it, unless `background_merges` is set.
+    '''
+    def __init__(self, state_size=2, vocab=None):
+        self.state_size = state_size
+        self.vocab = vocab if vocab is not None else Vocabulary()
+        self.bits = 64 // state_size
+        self.mask = (1 << self.bits) - 1
+        # low bits of a key, which are the high bits of its predecessors' keys
+        self.prefix_mask = (1 << (self.bits * (state_size - 1))) - 1
+        self.begin_key = 0
+        self.table = TransitionTable()
+        self.index = StateIndex()
+        # key -> {next token id: weight}
+        self.delta = {}
+        # key >> bits -> keys in delta, to find predecessors in delta
+        self.delta_prefix = {}
+        # token id -> keys of states in delta but not in the table
+        self.delta_index = {}
+        # number of states in delta but not in the table, so that len() is O(1)
+        self.new_states = 0
+        # key -> (successor dict, next token ids, cumulative weights) of walked states in delta
+        self.delta_dists = {}
+        self.min_merge_size = 10000
+        self.merge_ratio = 8
+        # set while another thread reads the table, so that changes stay in delta
+        self.frozen = False
+        # merge in a thread instead of stalling the change that triggers it
+        self.background_merges = False
+        # PendingMerge of the merge in progress
+        self.merging = None
+
+    def __len__(self):
+        return len(self.table) + self.new_states
+
+    def pack(self, token_ids):
+        key = 0
+        for token_id in reversed(token_ids):
+            key = (key << self.bits) | token_id
+        return key
+
+    def unpack(self, key):
+        rst = []
+        for _ in range(self.state_size):
+            rst.append(key & self.mask)
+            key >>= self.bits
+        return tuple(rst)
+
+    def add(self, runs, weight=1.):
+        # add `weight` for each transition in runs, negative weight to erase
+        # runs: iterable of token lists
+        intern = self.vocab.intern
+        shift = self.bits * (self.state_size - 1)
+        changed = {}
+        for run in runs:
+            key = self.begin_key
+            for token_id in [intern(tok) for tok in run] + [END_ID]:
+                succ = changed.get(key)
+                if succ is None:
+                    succ = changed[key] = self.touch(key)
+                succ[token_id] = succ.get(token_id, 0) + weight
+                key = (key >> self.bits) | (token_id << shift)
+        self.store(changed)
+        self.maybe_merge()
+
+    def touch(self, key):
+        # return: a copy of the successor weights of a state, to be changed and passed to store()
+        succ = self.delta.get(key)
+        if succ is not None:
+            return dict(succ)
+        state_id = self.table.find(key)
+        return self.table.weights(state_id) if state_id >= 0 else {}
+
+    def store(self, states):
+        '''
+        Put changed states into delta. Their successor dicts are replaced, never
+        changed in place, as walks in other threads and the merging thread may be
+        reading the old ones.
+        states: {key: {next token id: weight}}
+        '''
+        merging = self.merging
+        for key, succ in states.items():
+            if merging is not None and key not in merging.changed:
+                self.track_change(key)
+            if key in self.delta:
+                self.delta[key] = succ
+                self.delta_dists.pop(key, None)
+                continue
+            self.delta[key] = succ
+            self.delta_prefix.setdefault(key >> self.bits, []).append(key)
+            if self.table.find(key) < 0:
+                self.new_states += 1
+                for token_id in set(self.unpack(key)):
+                    self.delta_index.setdefault(token_id, []).append(key)
+
+    def track_change(self, key):
+        # add a state changed during the merge to the delta indexes kept for after it
+        merging = self.merging
+        merging.changed.add(key)
+        merging.delta_prefix.setdefault(key >> self.bits, []).append(key)
+        succ = merging.delta.get(key)
+        if succ is not None and not has_residual(succ):
+            merged = any(w > 0 for w in succ.values())
+        else:
+            merged = self.table.find(key) >= 0
+        if not merged:
+            merging.new_states += 1
+            for token_id in set(self.unpack(key)):
+                merging.delta_index.setdefault(token_id, []).append(key)
+
+    def merge(self):
+        # merge delta into a new compact table, and swap it in
+        if self.merging is not None:
+            self.finish_merge(wait=True)
+        if not self.delta:
+            return
+        delta = self.delta
+        self.table, self.index, residual = merge_table(self.table, delta, self.state_size, len(self.vocab))
+        self.delta = {}
+        self.delta_prefix = {}
+        self.delta_index = {}
+        self.new_states = 0
+        self.delta_dists = {}
+        self.store({key: delta[key] for key in residual})
+
+    def maybe_merge(self):
+        # merge once delta grows past a fraction of the table, in a thread if `background_merges`
+        if self.merging is not None:
+            self.finish_merge()
+        if self.frozen or len(self.delta) <= max(self.min_merge_size, len(self.table) // self.merge_ratio):
+            return
+        if self.background_merges:
+            self.start_merge()
+        else:
+            self.merge()
+
+    def start_merge(self):
+        '''
+        Build the merged table in a thread, from the table and a copy of delta.
+        Changes go on in delta meanwhile, and store() keeps track of the changed
+        states. The table is swapped in by finish_merge(), called on the next change.
+        '''
+        if self.merging is not None or not self.delta:
+            return
+        merging = self.merging = PendingMerge(self.table, dict(self.delta))
+        n_tokens = len(self.vocab)
+
+        def run():
+            try:
+                merging.result = merge_table(merging.table, merging.delta, self.state_size, n_tokens)
+            except Exception:
+                logging.exception('merge: failed to build the table')
+
+        merging.thread = threading.Thread(target=run, name='chain-merge', daemon=True)
+        merging.thread.start()
+
+    def finish_merge(self, wait=False):
+        # swap in the table built by start_merge(), if done or `wait`
+        merging = self.merging
+        if not wait and merging.thread.is_alive():
+            return
+        merging.thread.join()
+        self.merging = None
+        if merging.result is None or self.table is not merging.table:
+            # failed, all changes are still in delta
+            return
+        self.table, self.index, residual = merging.result
+        # states not changed since the copy are now the same in the table
+        delta = self.delta
+        self.delta = {key: delta[key] for key in merging.changed}
+        self.delta_prefix = merging.delta_prefix
+        self.delta_index = merging.delta_index
+        self.new_states = merging.new_states
+        self.delta_dists = {key: dist for key, dist in list(self.delta_dists.items()) if key in merging.changed}
+        self.store({key: delta[key] for key in residual if key not in merging.changed})
+
+    def successors(self, key):
+        # return: (next token ids, cumulative weights), raise KeyError if no such state
+        succ = self.delta.get(key)
+        if succ is not None:
+            return self.successors_of(succ)
+        state_id = self.table.find(key)
+        if state_id < 0:
+            raise KeyError(key)
+        return self.table.successors(state_id)
+
+    @staticmethod
+    def successors_of(succ):
+        # return: (next token ids, cumulative weights) of a successor dict
+        token_ids = sorted(t for t, w in succ.items() if w > 0)
+        return token_ids, list(accumulate(succ[t] for t in token_ids))
+
+    def weight(self, key, token_id):
+        succ = self.delta.get(key)
+        if succ is not None:
+            return succ.get(token_id, 0.)
+        state_id = self.table.find(key)
+        return self.table.weight(state_id, token_id) if state_id >= 0 else 0.
+
+    def move(self, key):
+        # return: a random next token id, raise KeyError if no such state, IndexError if no successors
+        succ = self.delta.get(key)
+        if succ is not None:
+            # cached until the state is changed, checked against the dict in case it's changed meanwhile
+            dist = self.delta_dists.get(key)
+            if dist is None or dist[0] is not succ:
+                dist = self.delta_dists[key] = (succ,) + self.successors_of(succ)
+            _, choices, cumdist = dist
+            return choices[bisect(cumdist, random.random() * cumdist[-1])]
+        table = self.table
+        state_id = table.find(key)
+        if state_id < 0:
+            raise KeyError(key)
+        # search in place, slicing would copy all successors of a hot state
+        a, b = table.slice(state_id)
+        if a == b:
+            raise IndexError(key)
+        i = bisect(table.cumdist, random.random() * table.cumdist[b-1], a, b)
+        if i == b:
+            raise IndexError(key)
+        return table.next_ids[i]
+
+    def iter_walk(self, key=None):
+        # yield: token ids following the state until END, so that callers can stop early
+        if key is None:
+            key = self.begin_key
+        shift = self.bits * (self.state_size - 1)
+        while True:
+            try:
+                token_id = self.move(key)
+            except (KeyError, IndexError):
+                # no state or no successors left, after erasing or pruning
+                return
+            if token_id == END_ID:
+                return
+            yield token_id
+            key = (key >> self.bits) | (token_id << shift)
+
+    def walk(self, key=None):
+        # return: token ids following the state until END
+        return list(self.iter_walk(key))
+
+    def walk_many(self, count, key=None, max_steps=None, deadline=None):
+        '''
+        Walk `count` times from the state at once. At each step, the next tokens of
+        all walks in table states are drawn with one vectorized search, walks in
+        delta states move one by one. Walks stop at END, and are returned
+        unfinished after `max_steps` tokens or at `deadline` (of time.monotonic()).
+        return: lists of token ids
+        '''
+        if key is None:
+            key = self.begin_key
+        keys, offsets, next_ids, cumdist = self.table.arrays()
+        bits = np.uint64(self.bits)
+        shift = np.uint64(self.bits * (self.state_size - 1))
+        rst = [[] for _ in range(count)]
+        active = np.arange(count)
+        current = np.full(count, key, dtype=np.uint64)
+        steps = 0
+        while len(active) and (max_steps is None or steps < max_steps):
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            steps += 1
+            # -1 ends the walk, like END
+            token_ids = np.full(len(active), -1, dtype=np.int64)
+            if len(keys):
+                state_ids = np.minimum(np.searchsorted(keys, current), len(keys) - 1)
+                in_table = keys[state_ids] == current
+            else:
+                state_ids = np.zeros(len(active), dtype=np.int64)
+                in_table = np.zeros(len(active), dtype=bool)
+            if self.delta:
+                in_delta = np.fromiter((k in self.delta for k in current.tolist()), dtype=bool, count=len(active))
+                for i in np.nonzero(in_delta)[0]:
+                    try:
+                        token_ids[i] = self.move(int(current[i]))
+                    except (KeyError, IndexError):
+                        pass
+                in_table &= ~in_delta
+            state_ids = state_ids[in_table]
+            # merged states always have successors
+            a, b = offsets[state_ids], offsets[state_ids + 1] - 1
+            totals = cumdist[b]
+            r = np.random.random(len(state_ids)) * totals
+            # binary search in the cumulative weights of each state at once, for the first one > r
+            lo, hi = a, b
+            while True:
+                searching = lo < hi
+                if not searching.any():
+                    break
+                mid = (lo + hi) // 2
+                right = cumdist[mid] <= r
+                lo = np.where(searching & right, mid + 1, lo)
+                hi = np.where(searching & ~right, mid, hi)
+            token_ids[in_table] = np.where(totals > 0, next_ids[lo].astype(np.int64), -1)
+
+            moved = (token_ids != END_ID) & (token_ids >= 0)
+            active, token_ids, current = active[moved], token_ids[moved], current[moved]
+            for walk, token_id in zip(active.tolist(), token_ids.tolist()):
+                rst[walk].append(token_id)
+            current = (current >> bits) | (token_ids.astype(np.uint64) << shift)
+        return rst
+
+    def predecessors(self, key):
+        # return: (token ids, weights) of tokens which can precede the state
+        prefix = key & self.prefix_mask
+        token_id = key >> (self.bits * (self.state_size - 1))
+        choices, weights = [], []
+        table = self.table
+        lo = bisect_left(table.keys, prefix << self.bits)
+        hi = bisect_left(table.keys, (prefix + 1) << self.bits, lo)
+        for state_id in range(lo, hi):
+            pred_key = table.keys[state_id]
+            if pred_key in self.delta:
+                continue
+            w = table.weight(state_id, token_id)
+            if w > 0:
+                choices.append(pred_key & self.mask)
+                weights.append(w)
+        for pred_key in self.delta_prefix.get(prefix, ()):
+            succ = self.delta.get(pred_key)
+            # merged meanwhile by another thread
+            if succ is None:
+                continue
+            w = succ.get(token_id, 0.)
+            if w > 0:
+                choices.append(pred_key & self.mask)
+                weights.append(w)
+        return choices, weights
+
+    def iter_walk_back(self, key):
+        # yield: token ids preceding the state back to BEGIN, nearest first
+        while key & self.mask != BEGIN_ID:
+            choices, weights = self.predecessors(key)
+            if not choices:
+                return
+            token_id = random.choices(choices, weights)[0]
+            if token_id != BEGIN_ID:
+                yield token_id
+            key = ((key << self.bits) & ((1 << (self.bits * self.state_size)) - 1)) | token_id
+
+    def walk_back(self, key):
+        # return: token ids preceding the state back to BEGIN, in sentence order
+        rst = list(self.iter_walk_back(key))
+        rst.reverse()
+        return rst
+
+    def keys(self):
+        # all state keys, unordered
+        for key in self.table.keys:
+            if key not in self.delta:
+                yield key
+        # fed meanwhile by another thread
+        yield from list(self.delta)
+
+    def state_groups(self, token_id):
+        # return: sequences of keys of states containing the token
+        table = self.table
+        shift = self.bits * (self.state_size - 1)
+        lo = bisect_left(table.keys, token_id << shift)
+        hi = bisect_left(table.keys, (token_id + 1) << shift, lo)
+        return (self.index.get(token_id), table.keys[lo:hi], self.delta_index.get(token_id, ()))
+
+    def count_states(self, token_id):
+        # return: number of states containing the token, without scanning
+        ## states in delta left without successors by erasing are counted until the next merge
+        return sum(map(len, self.state_groups(token_id)))
+
+    def is_live(self, key):
+        # whether the state has a successor of positive weight
+        succ = self.delta.get(key)
+        if succ is not None:
+            return any(w > 0 for w in succ.values())
+        state_id = self.table.find(key)
+        if state_id < 0:
+            return False
+        a, b = self.table.slice(state_id)
+        return b > a and self.table.cumdist[b-1] > 0
+
+    def random_state_with(self, token_id, tries=8):
+        # return: key of a random live state containing the token, raise KeyError if none
+        groups = self.state_groups(token_id)
+        total = sum(map(len, groups))
+        for _ in range(min(tries, total)):
+            i = random.randrange(total)
+            for group in groups:
+                if i < len(group):
+                    break
+                i -= len(group)
+            if self.is_live(group[i]):
+                return group[i]
+        # mostly erased, look at all of them
+        live = [key for group in groups for key in group if self.is_live(key)]
+        if not live:
+            raise KeyError(token_id)
+        return random.choice(live)
+
+    def add_transitions(self, items, weight=1.):
+        # items: iterable of (state tokens, {next token: weight}), like markovify.Chain.model.items()
+        intern = self.vocab.intern
+        changed = {}
+        for state, next_dict in items:
+            key = self.pack([intern(tok) for tok in state])
+            succ = changed.get(key)
+            if succ is None:
+                succ = changed[key] = self.touch(key)
+            for tok, w in next_dict.items():
+                token_id = intern(tok)
+                succ[token_id] = succ.get(token_id, 0) + w * weight
+        self.store(changed)
+        self.maybe_merge()
+
+    def items(self):
+        # yield: (state tokens, {next token: weight}), like markovify.Chain.model.items()
+        tokens = self.vocab
+        for key in self.keys():
+            succ = self.delta.get(key)
+            if succ is None:
+                succ = self.table.weights(self.table.find(key))
+            yield tuple(tokens[t] for t in self.unpack(key)), {tokens[t]: w for t, w in succ.items()}
+
+    def nbytes(self):
+        # rough memory usage of the chain, excluding the vocabulary
+        return self.table.nbytes() + sum(100 + 50 * len(succ) for succ in list(self.delta.values()))
+
+    def compacted(self, epsilon=1e-9, max_bytes=0):
+        '''
+        Build a compact copy of the table. Transitions with weight <= epsilon are
+        dropped, then states left without transitions (with the transitions
+        leading to them), and states not reachable from BEGIN. With max_bytes,
+        the lightest transitions are pruned until the table and its index fit,
+        keeping the heaviest one of each state. Tokens no longer used are dropped
+        from the vocabulary of the copy.
+        Only the table is read, so the chain may be fed in another thread
+        meanwhile if it's `frozen`. Pass the copy to copy_delta() afterwards.
+        return: (new chain, {'states'|'transitions'|'tokens'|'bytes': (before, after)})
+        '''
+        table = self.table
+        n_tokens = len(self.vocab)
+        n = len(table)
+        bits = np.uint64(self.bits)
+        mask = np.uint64(self.mask)
+        shift = np.uint64(self.bits * (self.state_size - 1))
+        keys = np.frombuffer(table.keys, dtype=np.uint64)
+        offsets = np.frombuffer(table.offsets, dtype=np.uint64).astype(np.int64)
+        next_ids = np.frombuffer(table.next_ids, dtype=np.uint32)
+        cumdist = np.frombuffer(table.cumdist, dtype=np.float64)
+
+        counts = np.diff(offsets)
+        nonempty = counts > 0
+        # state id of each transition
+        rows = np.repeat(np.arange(n), counts)
+        weights = np.diff(cumdist, prepend=0.)
+        weights[offsets[:-1][nonempty]] = cumdist[offsets[:-1][nonempty]]
+        keep = weights > epsilon
+
+        # state id reached by each transition, -1 for END
+        is_end = next_ids == END_ID
+        targets = (keys[rows] >> bits) | (next_ids.astype(np.uint64) << shift)
+        target_ids = np.minimum(np.searchsorted(keys, targets), max(n - 1, 0))
+        target_ids[is_end] = -1
+        # transitions to missing states can't be followed
+        keep &= is_end | (keys[target_ids] == targets) if n else keep
+
+        def drop_dead_ends(keep):
+            # drop transitions to states without transitions, until there are none
+            while True:
+                alive = np.bincount(rows[keep], minlength=n) > 0
+                new_keep = keep & (is_end | alive[target_ids])
+                if np.array_equal(new_keep, keep):
+                    return keep
+                keep = new_keep
+
+        def drop_unreachable(keep):
+            # breadth-first search from the BEGIN state
+            reached = np.zeros(n, dtype=bool)
+            begin_id = table.find(self.begin_key)
+            frontier = np.array([begin_id] if begin_id >= 0 else [], dtype=np.int64)
+            reached[frontier] = True
+            while len(frontier):
+                lo = offsets[frontier]
+                lengths = offsets[frontier + 1] - lo
+                # transitions of the frontier states
+                edges = np.repeat(lo - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+                edges = edges[keep[edges] & ~is_end[edges]]
+                frontier = np.unique(target_ids[edges])
+                frontier = frontier[~reached[frontier]]
+                reached[frontier] = True
+            return keep & reached[rows]
+
+        def nbytes(keep):
+            n_states = np.count_nonzero(np.bincount(rows[keep], minlength=n))
+            return (n_states * 8 * (self.state_size + 1) + np.count_nonzero(keep) * 12
+                    + (n_tokens + 1) * 8)
+
+        keep = drop_unreachable(drop_dead_ends(keep))
+        if max_bytes and nbytes(keep) > max_bytes:
+            candidates = np.where(keep, weights, -np.inf)
+            heaviest = np.full(n, -np.inf)
+            heaviest[nonempty] = np.maximum.reduceat(candidates, offsets[:-1][nonempty])
+            candidates = np.nonzero(keep & (candidates < heaviest[rows]))[0]
+            candidates = candidates[np.argsort(weights[candidates], kind='stable')]
+
+            def prune(count):
+                # pruned transitions may have been the only way to some states
+                pruned = keep.copy()
+                pruned[candidates[:count]] = False
+                return drop_unreachable(pruned)
+
+            # fewest lightest transitions to prune, as states dropped with them free more
+            lo, hi = 0, len(candidates)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if nbytes(prune(mid)) <= max_bytes:
+                    hi = mid
+                else:
+                    lo = mid + 1
+            keep = prune(lo)
+
+        # surviving tokens keep their order, and so do the keys and next ids
+        alive = np.bincount(rows[keep], minlength=n) > 0
+        new_keys = keys[alive]
+        used = np.zeros(n_tokens, dtype=bool)
+        used[[BEGIN_ID, END_ID]] = True
+        for i in range(self.state_size):
+            used[((new_keys >> (bits * np.uint64(i))) & mask).astype(np.int64)] = True
+        used[next_ids[keep]] = True
+        used = np.nonzero(used)[0]
+        vocab = Vocabulary()
+        for token_id in used[2:]:
+            vocab.intern(self.vocab[int(token_id)])
+        id_map = np.zeros(n_tokens, dtype=np.uint64)
+        id_map[used] = np.arange(len(used), dtype=np.uint64)
+        remapped = np.zeros(len(new_keys), dtype=np.uint64)
+        for i in range(self.state_size):
+            offset = bits * np.uint64(i)
+            remapped |= id_map[((new_keys >> offset) & mask).astype(np.int64)] << offset
+
+        new_counts = np.bincount(rows[keep], minlength=n)[alive]
+        new_offsets = np.concatenate(([0], np.cumsum(new_counts))).astype(np.uint64)
+        new_cumdist = np.cumsum(weights[keep])
+        # restart the sums at each state
+        new_cumdist -= np.repeat(np.concatenate(([0.], new_cumdist))[new_offsets[:-1].astype(np.int64)], new_counts)
+
+        chain = MarkovChain(self.state_size, vocab=vocab)
+        chain.min_merge_size = self.min_merge_size
+        chain.merge_ratio = self.merge_ratio
+        chain.table = TransitionTable(array('Q', remapped.tobytes()), array('Q', new_offsets.tobytes()),
+            array('I', id_map[next_ids[keep]].astype(np.uint32).tobytes()), array('d', new_cumdist.tobytes()))
+        chain.index = StateIndex.build(chain.table, self.state_size, len(vocab))
+        stats = {
+            'states': (n, len(chain.table)),
+            'transitions': (len(next_ids), len(chain.table.next_ids)),
+            'tokens': (n_tokens, len(vocab)),
+            'bytes': (table.nbytes() + self.index.nbytes(), chain.table.nbytes() + chain.index.nbytes()),
+        }
+        return chain, stats
+
+    def copy_delta(self, source, epsilon=1e-9):
+        # replace states with the ones changed in `source` since its last merge, such as
+        ## the chain this one was compacted from, dropping weights within epsilon of 0
+        intern = self.vocab.intern
+        tokens = source.vocab
+        changed = {}
+        for key, succ in source.delta.items():
+            changed[self.pack([intern(tokens[t]) for t in source.unpack(key)])] = {
+                intern(tokens[token_id]): w for token_id, w in succ.items() if abs(w) > epsilon}
+        self.store(changed)
+        self.maybe_merge()
+
+# snapshot file layout: header, then the following sections, each aligned to 8 bytes
+## token offsets (Q), token utf-8 blob, token order (I), keys (Q), offsets (Q), next ids (I), cumdist (d),
+## index offsets (Q), index keys (Q)
+SNAPSHOT_MAGIC = b'HNSBCHN\0'
+SNAPSHOT_VERSION = 2
+snapshot_header = struct.Struct('=8sIIqQQQQQQQ')
+
+def _aligned(n):
+    return (n + 7) // 8 * 8
+
+def write_snapshot(path, chain, watermark=0, checksum=0):
+    '''
+    Write the chain and its vocabulary into a binary snapshot file.
+    watermark, checksum: describe the corpus rows the chain was built from
+    '''
+    chain.merge()
+    vocab, table, index = chain.vocab, chain.table, chain.index
+    encoded = [vocab[i].encode('utf-8', 'surrogatepass') for i in range(len(vocab))]
+    token_offsets = array('Q', [0])
+    for tok in encoded:
+        token_offsets.append(token_offsets[-1] + len(tok))
+    token_order = array('I', sorted(range(len(encoded)), key=encoded.__getitem__))
+    sections = (token_offsets, b''.join(encoded), token_order,
+                table.keys, table.offsets, table.next_ids, table.cumdist,
+                index.offsets, index.keys)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(snapshot_header.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, chain.state_size,
+            watermark, checksum, len(encoded), token_offsets[-1], len(table), len(table.next_ids),
+            len(index.offsets), len(index.keys)))
+        for section in sections:
+            data = memoryview(section).cast('B')
+            f.write(data)
+            f.write(b'\0' * (_aligned(len(data)) - len(data)))
+    os.replace(tmp_path, path)
+
+def read_snapshot(path):
+    '''
+    Memory-map a snapshot written by write_snapshot. Nothing is copied: the
+    vocabulary and the transition table read the mapped file directly.
+    return: (chain, watermark, checksum), raise ValueError for invalid snapshots
+    '''
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mm) < snapshot_header.size:
+        raise ValueError('snapshot is truncated')
+    (magic, version, state_size, watermark, checksum, n_tokens, blob_size,
+        n_states, n_transitions, n_index_offsets, n_index_keys) = snapshot_header.unpack_from(mm)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError('not a snapshot file')
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f'unsupported snapshot version {version}')
+
+    buf = memoryview(mm)
+    pos = snapshot_header.size
+    def section(fmt, count):
+        nonlocal pos
+        size = struct.calcsize(fmt) * count
+        if pos + size > len(buf):
+            raise ValueError('snapshot is truncated')
+        rst = buf[pos:pos+size]
+        pos += _aligned(size)
+        return rst.cast(fmt) if fmt != 'B' else rst
+    token_offsets = section('Q', n_tokens + 1)
+    blob = section('B', blob_size)
+    token_order = section('I', n_tokens)
+    table = TransitionTable(section('Q', n_states), section('Q', n_states + 1),
+                            section('I', n_transitions), section('d', n_transitions))
+    index = StateIndex(section('Q', n_index_offsets), section('Q', n_index_keys))
+
+    chain = MarkovChain(state_size, vocab=MappedVocabulary(blob, token_offsets, token_order))
+    chain.table = table
+    chain.index = index
+    return chain, watermark, checksum
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from telethon.errors import FloodWaitError
+
+# message length limit of Telegram, with some room for markdown
+MAX_MESSAGE_LEN = 4000
+
+class ChatLog:
+    '''
+    Log of administrative actions, sent to a chat in the background.
+
+    log() queues an entry and returns right away. Every `interval` seconds,
+    queued entries are merged into as few digest messages as possible and sent,
+    followed by the messages they forward. At most `rate` requests are sent per
+    second, each sending a digest or forwarding up to 100 messages, and sending
+    is retried after FloodWaitError. Entries beyond
+    `max_pending` are dropped and counted in the next digest.
+    '''
+    def __init__(self, client, chat_id, interval=5., rate=0.3, max_pending=1000, parse_mode='md'):
+        self.client = client
+        self.chat_id = chat_id
+        self.interval = interval
+        self.rate = rate
+        self.max_pending = max_pending
+        self.parse_mode = parse_mode
+        # (text, messages to forward)
+        self.pending = []
+        self.dropped = 0
+        self.task = None
+        self.wake = None
+        self.closing = False
+
+    def log(self, text, fwd_msgs=None):
+        if not self.chat_id or self.closing:
+            return
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        if fwd_msgs is not None and not isinstance(fwd_msgs, list):
+            fwd_msgs = [fwd_msgs]
+        self.pending.append((text, fwd_msgs or []))
+        # started on first use, in the running loop
+        if self.task is None:
+            self.wake = asyncio.Event()
+            self.task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while not self.closing:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception('Failed to send log')
+        # entries queued while the last flush was sending
+        try:
+            await self.flush()
+        except Exception:
+            logging.exception('Failed to send log')
+
+    def _digests(self, entries):
+        texts = [text[:MAX_MESSAGE_LEN] for text, _ in entries]
+        if self.dropped:
+            texts.append(f'#log\n{self.dropped} log entries are dropped.')
+            self.dropped = 0
+        digest = ''
+        for text in texts:
+            if digest and len(digest) + len(text) + 2 > MAX_MESSAGE_LEN:
+                yield digest
+                digest = ''
+            digest = f'{digest}\n\n{text}' if digest else text
+        if digest:
+            yield digest
+
+    async def _send(self, request):
+        # request: coroutine function sending one request
+        while True:
+            try:
+                await request()
+                break
+            except FloodWaitError as e:
+                logging.warning(f'Log: flood wait for {e.seconds}s')
+                await asyncio.sleep(e.seconds)
+        await asyncio.sleep(1 / self.rate)
+
+    async def flush(self):
+        entries, self.pending = self.pending, []
+        if not entries and not self.dropped:
+            return
+        for digest in self._digests(entries):
+            await self._send(lambda: self.client.send_message(self.chat_id, digest, parse_mode=self.parse_mode))
+        fwd_msgs = [msg for _, msgs in entries for msg in msgs]
+        # forwarded in chunks of at most 100 messages, the limit of a single request
+        for start in range(0, len(fwd_msgs), 100):
+            chunk = fwd_msgs[start:start+100]
+            await self._send(lambda: self.client.forward_messages(self.chat_id, chunk))
+
+    async def close(self):
+        # send pending entries and stop
+        self.closing = True
+        if self.task is not None:
+            self.wake.set()
+            await self.task
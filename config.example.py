@@ -15,13 +15,91 @@ proxy_port = 1080
 
 # db file path
 dbfile = './mybot.db'
+# Binary snapshot of the model, written on exit and memory-mapped on startup
+# so that only the lines added since then are loaded from the db file
+# Set to empty string to always load all lines from the db file
+snapshot_path = './model.snapshot'
 STOPWORD_PATH = './stopwords.txt'  # mainly for wordcloud
+# CkipTagger tokenizes Traditional Chinese sentences in batches: sentences arriving
+# within `ckip_batch_wait` seconds are merged, up to `ckip_batch_size` sentences.
+# Messages are sent to the tokenizing workers in batches the same way.
+ckip_batch_size = 64
+ckip_batch_wait = 0.005
+# Tokenization engines not needed by your groups: 'cn' (pkuseg), 'tw' (CkipTagger), 'jp' (MeCab)
+# Traditional Chinese falls back to pkuseg, others fall back to splitting into characters
+# Disabling 'tw' avoids loading TensorFlow
+disabled_engines = ()
+# Load tokenization engines in the background on startup, instead of on first use
+# A fallback tokenizer is used until they are ready
+tokenizer_warm_up = True
+# Tokenization results of this many recent segments are cached (0 to disable)
+segment_cache_size = 10000
+# Tokenization runs in `worker_processes` processes (0 to tokenize in threads instead),
+# generation and word clouds run in `worker_threads` threads
+# Each worker process loads its own tokenizers, including CkipTagger
+worker_processes = 2
+worker_threads = 4
+# At most `worker_max_pending` jobs can be queued, and each job times out after `worker_timeout` seconds
+worker_max_pending = 64
+worker_timeout = 30
+# After /addword or /rmword, affected lines are re-tokenized `retokenize_batch_size` lines at a time
+# Re-tokenizing more than `retokenize_confirm_lines` lines requires root
+retokenize_batch_size = 1000
+retokenize_confirm_lines = 20000
+# /reprocessraw reads and re-tokenizes `reprocess_batch_size` raw texts at a time
+reprocess_batch_size = 1000
+# Ids of the last `own_message_cache_size` messages sent in each chat are kept,
+# to tell replies to the bot without fetching the replied messages
+own_message_cache_size = 1000
+# Replies in groups are generated from a chain of the last `partition_max_lines` lines of the group first,
+# if it has at least `partition_min_lines` lines, then from the chain of all chats
+# Chains of at most `partition_max_chats` groups, using at most `partition_max_bytes` bytes, are kept
+# (0 to disable), and dropped after `partition_idle_seconds` seconds without use
+partition_max_chats = 16
+partition_max_lines = 100000
+partition_min_lines = 1000
+partition_idle_seconds = 3600
+partition_max_bytes = 256 * 2**20
+# Up to `pool_size` sentences of each of these chains are generated ahead, `pool_batch` at a time,
+# when the bot is idle, and replied right away when no keyword is found (0 to disable)
+pool_size = 32
+pool_batch = 8
+# Rendered word clouds of this many (user, chat) pairs are cached, until they send new messages
+wordcloud_cache_size = 32
+# Database writes are committed together, every `db_commit_interval` seconds or every `db_commit_size` writes
+db_commit_interval = 0.05
+db_commit_size = 1000
+# Keep a Bloom filter of corpus line hashes in memory (about 2.4 bytes per line),
+# so that most new lines are stored without looking up duplicates
+dedup_filter = True
+# Serve metrics in the Prometheus format on http://`metrics_host`:`metrics_port`/metrics (0 to disable)
+# Root can also see them with /stats
+metrics_host = '127.0.0.1'
+metrics_port = 9464
+# Logs are merged and sent to `log_chat_id` every `log_interval` seconds, at most `log_rate` requests per second
+# (a digest, or up to 100 forwarded messages)
+log_interval = 5
+log_rate = 0.3
 
 # The following config can be changed dynamically by using `/reload_config` command
 
 # Limit the max length of response the bot can generate
 # For no limit, set this to 0 or negative
 MAX_MSG_LEN = 512
+# Stop generating a response after this many seconds, and send what is generated so far
+generate_seconds = 2
+# Reply with a pooled sentence containing a keyword of the message if there is one,
+# instead of generating a reply around the keyword
+pool_keyword_replies = False
+
+# Every `compact_interval` seconds (0 to disable, takes effect after restart if it was 0),
+# the chain is compacted in the background: transitions with weight <= `compact_epsilon`
+# left by erasing are dropped, then states which can no longer be reached
+# If `compact_max_bytes` is set, the rarest transitions are also pruned until the chain fits
+# Root can compact it right away with /compact
+compact_interval = 86400
+compact_epsilon = 1e-9
+compact_max_bytes = 0
 
 # Font used to generate wordcloud
 FONT_PATH = './PingFang.ttc'
@@ -0,0 +1,303 @@
+import re
+import math
+import time
+import queue
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import numpy as np
+from functools import lru_cache
+from concurrent.futures import Future
+from metrics import registry
+
+db_job_seconds = registry.histogram('db_job_seconds', 'Time of jobs in the database writer', ['job'])
+db_job_errors = registry.counter('db_job_errors_total', 'Failed jobs in the database writer', ['job'])
+db_commit_seconds = registry.histogram('db_commit_seconds', 'Time of commits in the database writer')
+db_commit_jobs = registry.histogram('db_commit_jobs', 'Jobs committed together',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+@lru_cache(maxsize=256)
+def statement_class(sql):
+    # e.g. 'insert user' for "INSERT OR IGNORE INTO user ...", to group timings of statements
+    m = re.search(r'\b(?:INTO|FROM|UPDATE)\s+(\w+)', sql, re.I)
+    return sql.split(None, 1)[0].lower() + (f' {m[1]}' if m else '')
+
+def content_hash(text):
+    # return: signed 64-bit hash of text, to fit in an SQLite integer
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+# trigram full-text indexes to find lines containing a word, kept up to date by triggers
+## corpus lines are indexed with whitespaces removed
+SEARCH_INDEX_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS raw_fts USING fts5(
+    raw_text, content='raw', content_rowid='raw_id', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS raw_fts_insert AFTER INSERT ON raw BEGIN
+    INSERT INTO raw_fts (rowid, raw_text) VALUES (new.raw_id, new.raw_text);
+END;
+CREATE TRIGGER IF NOT EXISTS raw_fts_delete AFTER DELETE ON raw BEGIN
+    INSERT INTO raw_fts (raw_fts, rowid, raw_text) VALUES ('delete', old.raw_id, old.raw_text);
+END;
+CREATE TRIGGER IF NOT EXISTS raw_fts_update AFTER UPDATE OF raw_text ON raw BEGIN
+    INSERT INTO raw_fts (raw_fts, rowid, raw_text) VALUES ('delete', old.raw_id, old.raw_text);
+    INSERT INTO raw_fts (rowid, raw_text) VALUES (new.raw_id, new.raw_text);
+END;
+CREATE VIRTUAL TABLE IF NOT EXISTS corpus_fts USING fts5(corpus_text, tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS corpus_fts_insert AFTER INSERT ON corpus BEGIN
+    INSERT INTO corpus_fts (rowid, corpus_text) VALUES (new.corpus_id, REPLACE(new.corpus_line, ' ', ''));
+END;
+CREATE TRIGGER IF NOT EXISTS corpus_fts_delete AFTER DELETE ON corpus BEGIN
+    DELETE FROM corpus_fts WHERE rowid = old.corpus_id;
+END;
+CREATE TRIGGER IF NOT EXISTS corpus_fts_update AFTER UPDATE OF corpus_line ON corpus BEGIN
+    UPDATE corpus_fts SET corpus_text = REPLACE(new.corpus_line, ' ', '') WHERE rowid = old.corpus_id;
+END;
+"""
+
+def init_search_index(cursor):
+    cursor.execute("SELECT name FROM sqlite_master WHERE name IN ('raw', 'corpus', 'raw_fts', 'corpus_fts')")
+    tables = set(r[0] for r in cursor.fetchall())
+    if not {'raw', 'corpus'} <= tables:
+        return
+    cursor.executescript(SEARCH_INDEX_SQL)
+    # index existing lines
+    if 'raw_fts' not in tables:
+        logging.info('Building full-text index of raw texts...')
+        cursor.execute("INSERT INTO raw_fts (raw_fts) VALUES ('rebuild')")
+    if 'corpus_fts' not in tables:
+        logging.info('Building full-text index of corpus lines...')
+        cursor.execute("INSERT INTO corpus_fts (rowid, corpus_text) SELECT corpus_id, REPLACE(corpus_line, ' ', '') FROM corpus")
+
+def add_content_hash(cursor, table, text_column, hash_column):
+    '''
+    Add `hash_column` with a unique index, holding 64-bit hashes of `text_column`.
+    If `text_column` has a unique constraint, the table is rebuilt without it.
+    return: whether the table is rebuilt
+    '''
+    cursor.execute(f"PRAGMA table_info({table})")
+    columns = [r[1] for r in cursor.fetchall()]
+    if hash_column not in columns:
+        logging.info(f'Adding {hash_column} to {table}...')
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {hash_column} integer")
+        cursor.execute(f"UPDATE {table} SET {hash_column} = content_hash({text_column})")
+        columns.append(hash_column)
+    # the unique constraint is an index on text_column with origin 'u'
+    cursor.execute(f"PRAGMA index_list({table})")
+    unique_indexes = [r[1] for r in cursor.fetchall() if r[3] == 'u']
+    rebuild = False
+    for index in unique_indexes:
+        cursor.execute(f"PRAGMA index_info({index})")
+        if [r[2] for r in cursor.fetchall()] == [text_column]:
+            rebuild = True
+    if rebuild:
+        logging.info(f'Rebuilding {table} without unique {text_column}...')
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        sql, = cursor.fetchone()
+        sql = re.sub(rf'\b{table}\b', f'{table}_new', sql, count=1)
+        sql = re.sub(rf'(\b{text_column}\b[^,]*?)\s+UNIQUE\b', r'\1', sql, count=1, flags=re.I)
+        column_list = ', '.join(columns)
+        cursor.execute(sql)
+        cursor.execute(f"INSERT INTO {table}_new ({column_list}) SELECT {column_list} FROM {table}")
+        cursor.execute(f"DROP TABLE {table}")
+        cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {hash_column}_index ON {table} ({hash_column})")
+    return rebuild
+
+def migrate_content_hashes(cursor):
+    # duplicate lines and texts are found by hashes, instead of unique text indexes
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('raw', 'corpus')")
+    if len(cursor.fetchall()) < 2:
+        return
+    rebuilt = add_content_hash(cursor, 'corpus', 'corpus_line', 'corpus_hash')
+    rebuilt = add_content_hash(cursor, 'raw', 'raw_text', 'raw_hash') or rebuilt
+    cursor.connection.commit()
+    if rebuilt:
+        logging.info('Vacuuming database...')
+        cursor.execute("VACUUM")
+
+def init_db(cursor):
+    # bring the schema of an existing db up to date, see README.md for creating tables
+    migrate_content_hashes(cursor)
+    init_search_index(cursor)
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'corpus'")
+    if cursor.fetchone():
+        cursor.execute("CREATE INDEX IF NOT EXISTS corpus_raw_index ON corpus (corpus_raw)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS corpus_chat_index ON corpus (corpus_chat)")
+
+class HashFilter:
+    '''
+    Bloom filter of 64-bit content hashes. A hash not in the filter was never added,
+    a hash in the filter was added with probability about 1 - `error_rate`,
+    as long as at most `capacity` hashes are added.
+    '''
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 64)
+        self.hash_count = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        self.count = 0
+
+    def _positions(self, hashes):
+        # double hashing: the i-th position is h1 + i*h2
+        hashes = np.asarray(hashes, dtype=np.int64).astype(np.uint64)
+        h1 = hashes & np.uint64(0xffffffff)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        i = np.arange(self.hash_count, dtype=np.uint64)
+        return (h1[:, None] + i * h2[:, None]) % np.uint64(self.size)
+
+    def add_many(self, hashes):
+        if not len(hashes):
+            return
+        positions = self._positions(hashes).ravel()
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3),
+                         np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+        self.count += len(hashes)
+
+    def add(self, h):
+        self.add_many([h])
+
+    def __contains__(self, h):
+        # same positions as _positions(), without numpy overhead for a single hash
+        h &= 0xffffffffffffffff
+        h1, h2 = h & 0xffffffff, (h >> 32) | 1
+        for i in range(self.hash_count):
+            position = (h1 + i * h2) % self.size
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def full(self):
+        return self.count > self.capacity
+
+def connect(path):
+    # connection for writing, in WAL mode and with SQL function content_hash(text)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.create_function('content_hash', 1, content_hash, deterministic=True)
+    return conn
+
+def end_savepoint(cursor, rollback=False):
+    try:
+        if rollback:
+            cursor.execute("ROLLBACK TO job")
+        cursor.execute("RELEASE job")
+    except sqlite3.OperationalError as e:
+        # gone if the job committed by itself, such as before a VACUUM
+        if 'no such savepoint' not in str(e):
+            raise
+
+class Database:
+    '''
+    SQLite database with a dedicated writer thread.
+
+    Write jobs are functions taking a cursor, run by the writer in the order they
+    are submitted. Jobs submitted within `commit_interval` seconds, up to
+    `commit_size` of them, are committed together in a single transaction.
+    Jobs see the writes of earlier jobs, even before they are committed, but
+    their results are given once committed. If the commit fails, all of them fail.
+    SQL function content_hash(text) is available to jobs.
+
+    The database is switched to WAL mode, so `reader`, the connection for reads
+    in the event loop thread, is not blocked by the writer. It only sees
+    committed writes.
+    '''
+    def __init__(self, path, commit_interval=0.05, commit_size=1000):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.commit_size = commit_size
+        self.jobs = queue.Queue()
+        self.writer = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self.writer.start()
+        # WAL mode is set by the writer before the first job
+        self.submit(lambda cursor: None).result()
+        self.reader = sqlite3.connect(path)
+        registry.gauge('db_queue_size', 'Jobs waiting for the database writer', self.jobs.qsize)
+
+    def _run(self):
+        conn = connect(self.path)
+        cursor = conn.cursor()
+        stopping = False
+        while not stopping:
+            job = self.jobs.get()
+            if job is None:
+                break
+            jobs = [job]
+            results = []
+            try:
+                results.append(self._run_job(cursor, job))
+                deadline = time.monotonic() + self.commit_interval
+                # group the following jobs into the same transaction
+                while len(jobs) < self.commit_size:
+                    try:
+                        job = self.jobs.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        stopping = True
+                        break
+                    jobs.append(job)
+                    results.append(self._run_job(cursor, job))
+                with db_commit_seconds.time():
+                    conn.commit()
+            except Exception as e:
+                # such as SQLITE_BUSY, a full disk or I/O errors, none of the group is written
+                logging.exception('Database commit failed')
+                db_job_errors.inc('commit')
+                try:
+                    conn.rollback()
+                except sqlite3.Error:
+                    logging.exception('Database rollback failed')
+                for _, _, future, _ in jobs:
+                    future.set_exception(e)
+            else:
+                # results are given once committed
+                for future, result, error in results:
+                    if error is None:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(error)
+            db_commit_jobs.observe(len(jobs))
+        conn.close()
+
+    def _run_job(self, cursor, job):
+        # each job runs in a savepoint of the transaction, so that a failed one leaves none of its writes
+        # return: (future, result, exception)
+        func, args, future, name = job
+        if not cursor.connection.in_transaction:
+            cursor.execute("BEGIN")
+        cursor.execute("SAVEPOINT job")
+        try:
+            with db_job_seconds.time(name):
+                result = func(cursor, *args)
+        except Exception as e:
+            logging.exception('Database write failed')
+            db_job_errors.inc(name)
+            end_savepoint(cursor, rollback=True)
+            return future, None, e
+        end_savepoint(cursor)
+        return future, result, None
+
+    def submit(self, func, *args, name=None):
+        # run func(cursor, *args) in the writer, timed as `name` (the name of func by default)
+        # return: concurrent.futures.Future of its result
+        future = Future()
+        self.jobs.put((func, args, future, name or func.__name__))
+        return future
+
+    async def write(self, func, *args):
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    def execute(self, sql, parameters=()):
+        # fire and forget, failures are logged
+        self.submit(lambda cursor: cursor.execute(sql, parameters).rowcount, name=statement_class(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        self.submit(lambda cursor: cursor.executemany(sql, seq_of_parameters).rowcount, name=statement_class(sql))
+
+    def close(self):
+        # commit pending writes and stop the writer
+        self.jobs.put(None)
+        self.writer.join()
+        self.reader.close()
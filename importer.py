@@ -0,0 +1,264 @@
+'''
+Import Telegram Desktop chat exports into the database, then update the model snapshot.
+
+    python importer.py result.json [result.json ...]
+
+Each export (a single chat in JSON format) is read as a stream, so it needs not
+fit in memory. Messages are tokenized in a process pool and stored in large
+transactions, together with the id of the last stored message of the chat, so an
+interrupted import resumes where it stopped. Stop the bot while importing.
+'''
+import re
+import json
+import time
+import config
+import logging
+import argparse
+import multiprocessing
+from os import cpu_count
+from collections import deque
+from markov import CorpusModel
+from workers import _init_process, _cut
+from database import connect, init_db
+
+# same as tgbot.py
+USER_RIGHT_LEVEL_BANNED  = -1
+DEFAULT_USER_RIGHT_LEVEL = 1
+
+messages_re = re.compile(r'"messages"\s*:\s*\[')
+separator_re = re.compile(r'[\s,]*')
+
+def read_export(path, chunk_size=1 << 20):
+    '''
+    Read a chat export as a stream.
+    return: the chat (fields other than messages), an iterator of its messages
+    '''
+    f = open(path, encoding='utf-8')
+    buf = ''
+    # the fields before messages are short
+    while True:
+        m = messages_re.search(buf)
+        if m:
+            break
+        chunk = f.read(chunk_size)
+        if not chunk:
+            raise ValueError(f'{path}: messages not found')
+        buf += chunk
+    try:
+        chat = json.loads(buf[:m.start()].rstrip().rstrip(',') + '}')
+    except json.JSONDecodeError:
+        raise ValueError(f'{path}: not a single chat export')
+
+    def messages():
+        nonlocal buf
+        decoder = json.JSONDecoder()
+        pos = m.end()
+        with f:
+            while True:
+                pos = separator_re.match(buf, pos).end()
+                if pos < len(buf):
+                    if buf[pos] == ']':
+                        return
+                    try:
+                        message, pos = decoder.raw_decode(buf, pos)
+                        yield message
+                        continue
+                    except json.JSONDecodeError:
+                        # the message continues in the next chunk
+                        pass
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise ValueError(f'{path}: unexpected end of file')
+                buf = buf[pos:] + chunk
+                pos = 0
+
+    return chat, messages()
+
+def chat_tgid(chat):
+    # ids in exports are without the prefix in bot api ids
+    if chat['type'] in ('personal_chat', 'bot_chat', 'saved_messages'):
+        return chat['id']
+    if chat['type'] == 'private_group':
+        return -chat['id']
+    return int(f'-100{chat["id"]}')
+
+def sender_tgid(from_id):
+    # from_id: user123 or channel123
+    if from_id.startswith('user'):
+        return int(from_id[4:])
+    return int(f'-100{from_id[7:]}')
+
+def message_text(message):
+    text = message.get('text', '')
+    if isinstance(text, list):
+        # formatted text, as plain strings and entities
+        text = ''.join(t if isinstance(t, str) else t.get('text', '') for t in text)
+    return text
+
+def message_time(message):
+    if 'date_unixtime' in message:
+        return int(message['date_unixtime'])
+    return int(time.mktime(time.strptime(message['date'], '%Y-%m-%dT%H:%M:%S')))
+
+class Importer:
+    def __init__(self, conn, model, pool, processes, batch_size=1000, commit_size=50000):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.model = model
+        self.pool = pool
+        # batches waiting or being tokenized
+        self.max_pending = 2 * processes
+        self.batch_size = batch_size
+        self.commit_size = commit_size
+        self.get_line_weight = config.get_line_weight if hasattr(config, 'get_line_weight') else lambda line: 1.
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS import_progress(
+                progress_chat integer PRIMARY KEY,
+                progress_message integer
+            )""")
+        # tgid: (user_id, user_right, user_weight)
+        self.users = {}
+        self.cursor.execute("SELECT user_tgid, user_id, user_right, user_weight FROM user")
+        for user_tgid, user_id, user_right, user_weight in self.cursor.fetchall():
+            self.users[user_tgid] = (user_id, user_right or DEFAULT_USER_RIGHT_LEVEL, user_weight or 1.)
+
+    def find_user(self, user_tgid, user_name):
+        if user_tgid not in self.users:
+            self.cursor.execute("""
+                INSERT INTO user (user_tgid, user_name, user_right, user_weight)
+                VALUES (?,?,?,?)
+                """, (user_tgid, user_name, DEFAULT_USER_RIGHT_LEVEL, 1.))
+            self.users[user_tgid] = (self.cursor.lastrowid, DEFAULT_USER_RIGHT_LEVEL, 1.)
+        return self.users[user_tgid]
+
+    def find_chat(self, chat_tgid, chat_name):
+        self.cursor.execute("INSERT OR IGNORE INTO chat (chat_tgid, chat_name) VALUES (?,?)", (chat_tgid, chat_name))
+        self.cursor.execute("SELECT chat_id FROM chat WHERE chat_tgid = ?", (chat_tgid,))
+        chat_id, = self.cursor.fetchone()
+        return chat_id
+
+    def batches(self, messages, last_message):
+        # yield: lists of (message id, time, user_id, user_weight, text)
+        batch = []
+        for message in messages:
+            if message.get('type') != 'message' or message['id'] <= last_message:
+                continue
+            # like the bot, skip forwarded messages and commands
+            if 'forwarded_from' in message or 'from_id' not in message:
+                continue
+            text = message_text(message).strip()
+            if not text or text.startswith('/'):
+                continue
+            user_id, user_right, user_weight = self.find_user(sender_tgid(message['from_id']), message.get('from') or '')
+            if user_right <= USER_RIGHT_LEVEL_BANNED:
+                continue
+            batch.append((message['id'], message_time(message), user_id, user_weight, text))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def tokenized(self, batches):
+        # yield: (batch, tokens of its texts), with a bounded number of batches in the pool
+        pending = deque()
+        for batch in batches:
+            pending.append((batch, self.pool.apply_async(_cut, ([b[-1] for b in batch], 0))))
+            if len(pending) > self.max_pending:
+                batch, result = pending.popleft()
+                yield batch, result.get()
+        while pending:
+            batch, result = pending.popleft()
+            yield batch, result.get()
+
+    def store(self, chat_id, batch, tokens):
+        corpus_rows = []
+        for (message_id, timestamp, user_id, user_weight, text), message_tokens in zip(batch, tokens):
+            lines = self.model.cut_lines(text, message_tokens) if message_tokens else []
+            if not lines:
+                continue
+            self.cursor.execute("""
+                INSERT INTO raw (raw_text, raw_hash) VALUES (?, content_hash(?))
+                ON CONFLICT (raw_hash) DO UPDATE SET raw_hash = excluded.raw_hash
+                RETURNING raw_id
+                """, (text, text))
+            raw_id, = self.cursor.fetchone()
+            for line in lines:
+                corpus_rows.append((timestamp, line, line, raw_id, chat_id, user_id,
+                                    user_weight * self.get_line_weight(line)))
+        self.cursor.executemany("""
+            INSERT OR IGNORE INTO corpus (corpus_time, corpus_line, corpus_hash, corpus_raw, corpus_chat, corpus_user, corpus_weight)
+            VALUES (?,?,content_hash(?),?,?,?,?)
+            """, corpus_rows)
+        return len(corpus_rows)
+
+    def import_export(self, path):
+        chat, messages = read_export(path)
+        tgid = chat_tgid(chat)
+        self.cursor.execute("SELECT progress_message FROM import_progress WHERE progress_chat = ?", (tgid,))
+        rst = self.cursor.fetchone()
+        last_message = rst[0] if rst else 0
+        if last_message:
+            logging.info(f'{path}: resuming after message {last_message}')
+        chat_id = self.find_chat(tgid, chat.get('name') or '')
+
+        start = time.monotonic()
+        message_count = 0
+        line_count = 0
+        uncommitted = 0
+        for batch, tokens in self.tokenized(self.batches(messages, last_message)):
+            line_count += self.store(chat_id, batch, tokens)
+            message_count += len(batch)
+            uncommitted += len(batch)
+            if uncommitted >= self.commit_size:
+                self.commit(tgid, batch[-1][0])
+                uncommitted = 0
+                rate = message_count / (time.monotonic() - start) * 60
+                logging.info(f'{path}: {message_count} messages, {line_count} lines, {rate:.0f} messages/min')
+            last_message = batch[-1][0]
+        self.commit(tgid, last_message)
+        logging.info(f'{path}: imported {message_count} messages, {line_count} lines in {time.monotonic() - start:.0f}s')
+
+    def commit(self, tgid, last_message):
+        # progress is committed with the rows, so that it's never ahead of them
+        self.cursor.execute("INSERT OR REPLACE INTO import_progress (progress_chat, progress_message) VALUES (?,?)",
+            (tgid, last_message))
+        self.conn.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description='Import Telegram Desktop chat exports (result.json).')
+    parser.add_argument('paths', nargs='+', metavar='result.json')
+    parser.add_argument('-p', '--processes', type=int, default=cpu_count(), help='tokenization processes')
+    parser.add_argument('--batch-size', type=int, default=1000, help='messages per tokenization job')
+    parser.add_argument('--commit-size', type=int, default=50000, help='messages per transaction')
+    args = parser.parse_args()
+
+    tokenizer_options = {
+        'ckip_batch_size': config.ckip_batch_size if hasattr(config, 'ckip_batch_size') else 64,
+        'ckip_batch_wait': config.ckip_batch_wait if hasattr(config, 'ckip_batch_wait') else 0.005,
+        'segment_cache_size': config.segment_cache_size if hasattr(config, 'segment_cache_size') else 10000,
+        'disabled_engines': config.disabled_engines if hasattr(config, 'disabled_engines') else (),
+    }
+    # fork before loading anything large
+    ## no warm-up: engines load on the first cut instead of falling back, which would store other tokens
+    pool = multiprocessing.get_context('fork').Pool(args.processes, _init_process, (tokenizer_options, False))
+    model = CorpusModel(**tokenizer_options)
+    conn = connect(config.dbfile)
+    init_db(conn.cursor())
+
+    importer = Importer(conn, model, pool, args.processes, batch_size=args.batch_size, commit_size=args.commit_size)
+    try:
+        for path in args.paths:
+            importer.import_export(path)
+    finally:
+        pool.terminate()
+        conn.close()
+
+    snapshot_path = config.snapshot_path if hasattr(config, 'snapshot_path') else ''
+    if snapshot_path:
+        logging.info('Updating model snapshot...')
+        model.load_db(config.dbfile, snapshot_path)
+        model.save_snapshot(snapshot_path, config.dbfile)
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,20 @@
+import os
 import re
 import json
-import random
+import time
+import queue
+import threading
+import hashlib
 import logging
-import MeCab
-import pkuseg
-import markovify
+import sqlite3
 import pycld2 as cld2
 from itertools import islice
-from ckiptagger import data_utils, construct_dictionary, WS, POS, NER
+from collections import OrderedDict
+from os.path import isfile
+from types import SimpleNamespace
+from markovify.splitters import split_into_sentences
+from chain import MarkovChain, BEGIN_ID, read_snapshot, write_snapshot
+from metrics import registry
 
 logging.basicConfig(level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -23,8 +30,174 @@ ender_punct_re = re.compile(f'((?:[{re.escape(ENDER_PUNCT_LIST)}]|[{re.escape(EN
 # katakana and hiragana
 japanese_re = re.compile(r'[\u30a0-\u30ff\u3040-\u309f]')
 cjk_re = re.compile(r'[\u4e00-\u9fff]')
+# every cjk character or kana is a token, other characters are kept in runs
+fallback_re = re.compile(r'[\u3040-\u30ff\u4e00-\u9fff]|[^\s\u3040-\u30ff\u4e00-\u9fff]+')
+# set when a fallback tokenizer was used by the current thread, so that the result is not cached
+fallback_state = threading.local()
 
-def cut(text, cn_tok, tw_tok, jp_tok, tw_dict=None):
+tokenizer_seconds = registry.histogram('tokenizer_seconds', 'Time spent in tokenization engines', ['engine'])
+segment_cache_lookups = registry.counter('segment_cache_lookups_total', 'Lookups in segment caches', ['result'])
+
+def fallback_cut(text):
+    return fallback_re.findall(text)
+
+class LazyEngine:
+    '''
+    A tokenization engine loaded on first use. While another thread is loading
+    it, get() returns None instead of waiting, so that the caller can use a
+    fallback. Disabled engines are never loaded.
+    '''
+    def __init__(self, name, loader, enabled=True):
+        self.name = name
+        self.loader = loader
+        self.enabled = enabled
+        self.engine = None
+        self.lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.engine is not None
+
+    def load(self, blocking=True):
+        if not self.enabled:
+            return None
+        if self.engine is None and self.lock.acquire(blocking):
+            try:
+                if self.engine is None:
+                    logging.info(f'Loading {self.name}...')
+                    start = time.monotonic()
+                    self.engine = self.loader()
+                    logging.info(f'Loaded {self.name} in {time.monotonic() - start:.1f}s')
+            finally:
+                self.lock.release()
+        return self.engine
+
+    def get(self):
+        engine = self.load(blocking=False)
+        if engine is None and self.enabled:
+            fallback_state.used = True
+        return engine
+
+class UserDict:
+    '''
+    Words of a user dictionary, kept in a set and saved to an append-only file.
+    A line of the file adds a word, or removes it if it starts with `removed_prefix`.
+    The file is compacted into a plain word list once most of its lines are stale.
+    '''
+    removed_prefix = '-\t'
+
+    def __init__(self, path):
+        self.path = path
+        self.words = set()
+        # lines in the file
+        self.lines = 0
+        # increases whenever words change
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        words = set()
+        lines = 0
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    lines += 1
+                    if line.startswith(self.removed_prefix):
+                        words.discard(line[len(self.removed_prefix):].strip())
+                    else:
+                        words.add(line.split('\t')[0].strip())
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.words = words
+            self.lines = lines
+            self.version += 1
+
+    def __contains__(self, word):
+        return word in self.words
+
+    def _append(self, line):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+        self.lines += 1
+        if self.lines > 2 * len(self.words) + 100:
+            self._compact()
+
+    def _compact(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(''.join(word + '\n' for word in sorted(self.words)))
+        os.replace(tmp_path, self.path)
+        self.lines = len(self.words)
+
+    def add(self, word):
+        with self.lock:
+            if word in self.words:
+                return False
+            self.words.add(word)
+            self.version += 1
+            self._append(word)
+        return True
+
+    def remove(self, word):
+        with self.lock:
+            if word not in self.words:
+                return False
+            self.words.discard(word)
+            self.version += 1
+            self._append(self.removed_prefix + word)
+        return True
+
+    def compact(self):
+        with self.lock:
+            self._compact()
+
+class SegmentCache:
+    '''
+    Bounded LRU cache of segment tokenization results.
+    Keys include `version`, the version of the user dictionaries.
+    '''
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.version = 0
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, segment):
+        key = (self.version, segment)
+        with self.lock:
+            tokens = self.data.get(key)
+            if tokens is None:
+                self.misses += 1
+                segment_cache_lookups.inc('miss')
+                return None
+            self.hits += 1
+            segment_cache_lookups.inc('hit')
+            self.data.move_to_end(key)
+            return tokens
+
+    def put(self, segment, tokens):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data[(self.version, segment)] = tuple(tokens)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self, version=None):
+        with self.lock:
+            self.data.clear()
+            if version is not None:
+                self.version = version
+
+    def stats(self):
+        return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses}
+
+def cut(text, cn_tok, tw_tok, jp_tok, tw_dict=None, cache=None):
     def _cut(tup):
         (i, t) = tup
         # punctuations
@@ -34,7 +207,8 @@ def cut(text, cn_tok, tw_tok, jp_tok, tw_dict=None):
         if not t:
             return []
         try:
-            reliable, _, langs = cld2.detect(t)
+            with tokenizer_seconds.time('cld2'):
+                reliable, _, langs = cld2.detect(t)
         except cld2.error:
             # input contains invalid UTF-8 around byte ...
             # we refuse to tokenize if such thing happens
@@ -43,7 +217,8 @@ def cut(text, cn_tok, tw_tok, jp_tok, tw_dict=None):
             if langs[0][0] == 'Chinese':
                 return cn_tok.cut(t)
             elif langs[0][0] == 'ChineseT':
-                return tw_tok([t], recommend_dictionary=tw_dict, segment_delimiter_set={})[0]
+                # tokenized below, in one batch for the whole text
+                return None
             elif langs[0][0] == 'Japanese':
                 return jp_tok.parse(t).split()
             else:
@@ -58,9 +233,98 @@ def cut(text, cn_tok, tw_tok, jp_tok, tw_dict=None):
                 return cn_tok.cut(t)
             else:
                 return [t]
+    def _cached_cut(tup):
+        (i, t) = tup
+        if cache is None or i % 2 or not t:
+            return _cut(tup)
+        tokens = cache.get(t)
+        if tokens is None:
+            fallback_state.used = False
+            tokens = _cut(tup)
+            if tokens is not None and not fallback_state.used:
+                cache.put(t, tokens)
+        return tokens
     # tokenize each part, split by punctuations
+    parts = punct_re.split(text)
+    rst = list(map(_cached_cut, enumerate(parts)))
+    tw_idx = [i for i, tokens in enumerate(rst) if tokens is None]
+    if tw_idx:
+        fallback_state.used = False
+        tw_rst = tw_tok([parts[i] for i in tw_idx], recommend_dictionary=tw_dict, segment_delimiter_set={})
+        for i, tokens in zip(tw_idx, tw_rst):
+            rst[i] = tokens
+            if cache is not None and not fallback_state.used:
+                cache.put(parts[i], tokens)
     # flatten list
-    return [item for sublist in map(_cut, enumerate(punct_re.split(text))) for item in sublist if item]
+    return [item for sublist in rst for item in sublist if item]
+
+class BatchedWS:
+    '''
+    Drop-in wrapper of CkipTagger WS. Sentences from concurrent calls arriving
+    within `max_wait` seconds (up to `batch_size` sentences) are tokenized in
+    one WS call by a dispatcher thread, and each caller gets its own results back.
+    '''
+    def __init__(self, ws, batch_size=64, max_wait=0.005):
+        self.ws = ws
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='ckip-batcher', daemon=True)
+        self.thread.start()
+
+    def __call__(self, sentence_list, recommend_dictionary=None, segment_delimiter_set=None):
+        if not sentence_list:
+            return []
+        job = {
+            'sentences': list(sentence_list),
+            'options': (recommend_dictionary, segment_delimiter_set),
+            'done': threading.Event(),
+        }
+        self.queue.put(job)
+        job['done'].wait()
+        if 'error' in job:
+            raise job['error']
+        return job['result']
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            count = len(batch[0]['sentences'])
+            deadline = time.monotonic() + self.max_wait
+            while count < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    job = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(job)
+                count += len(job['sentences'])
+            # jobs with different dictionaries cannot share a call
+            groups = {}
+            for job in batch:
+                recommend_dictionary, segment_delimiter_set = job['options']
+                groups.setdefault((id(recommend_dictionary), frozenset(segment_delimiter_set or ())), []).append(job)
+            for jobs in groups.values():
+                self.process(jobs)
+
+    def process(self, jobs):
+        recommend_dictionary, segment_delimiter_set = jobs[0]['options']
+        sentences = [sentence for job in jobs for sentence in job['sentences']]
+        try:
+            rst = self.ws(sentences, recommend_dictionary=recommend_dictionary or {},
+                          segment_delimiter_set=segment_delimiter_set or {})
+        except Exception as e:
+            for job in jobs:
+                job['error'] = e
+                job['done'].set()
+            return
+        pos = 0
+        for job in jobs:
+            job['result'] = rst[pos:pos+len(job['sentences'])]
+            pos += len(job['sentences'])
+            job['done'].set()
 
 def isascii(char):
     # For Python 3.6 support
@@ -90,61 +354,317 @@ def join(text):
 
     return rst
 
-class CorpusModel:
-    def __init__(self):
-        # init model which at least contains something
-        self.model = markovify.NewlineText('Hello world.\n', retain_original=False, well_formed=False)
-        self.path = ''
-        self.wakati = MeCab.Tagger('-Owakati')
+word_split_re = re.compile(r'\s+')
+newline_split_re = re.compile(r'\s*\n\s*')
+
+def split_runs(text, newline=True):
+    # parse text into runs exactly like markovify.NewlineText (newline=True)
+    # or markovify.Text (newline=False) does
+    sentences = newline_split_re.split(text) if newline else split_into_sentences(text)
+    return [word_split_re.split(s) for s in sentences if s.strip()]
+
+def feed_chain(chain, lines, weights):
+    for line, weight in zip(lines, weights):
+        chain.add(split_runs(line, newline=False), weight)
+
+def build_chain(rows):
+    # rows: (line, weight)
+    chain = MarkovChain()
+    for line, weight in rows:
+        chain.add(split_runs(line, newline=False), weight)
+    return chain
+
+def corpus_checksum(cursor, watermark):
+    # a cheap fingerprint of the corpus rows up to watermark,
+    # which changes when rows are deleted, re-weighted or re-tokenized
+    cursor.execute("""
+        SELECT COUNT(*), TOTAL(corpus_id), TOTAL(corpus_weight), TOTAL(LENGTH(corpus_line))
+        FROM corpus WHERE corpus_id <= ?
+        """, (watermark,))
+    digest = hashlib.blake2b(repr(cursor.fetchone()).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+class Tokenizer:
+    '''
+    Word segmentation engines with their user dictionaries.
+    `dict_version` increases whenever the user dictionaries change.
+
+    Engines (cn: pkuseg, tw: CkipTagger, jp: MeCab) are loaded on first use, or
+    by warm_up() in the background. Until an engine is ready, or if it is
+    disabled, its text is tokenized by pkuseg (for tw) or into characters.
+    '''
+    def __init__(self, ckip_batch_size=64, ckip_batch_wait=0.005, segment_cache_size=10000, disabled_engines=()):
+        self.options = {'ckip_batch_size': ckip_batch_size, 'ckip_batch_wait': ckip_batch_wait,
+                        'segment_cache_size': segment_cache_size, 'disabled_engines': disabled_engines}
+        self.dict_version = 0
+        self.cache = SegmentCache(segment_cache_size)
+        self.cn_dict = UserDict('./pkuseg_dict.txt')
+        self.engines = {
+            'cn': LazyEngine('pkuseg', self.load_pkuseg, 'cn' not in disabled_engines),
+            'tw': LazyEngine('CkipTagger', self.load_ckip, 'tw' not in disabled_engines),
+            'jp': LazyEngine('MeCab', self.load_mecab, 'jp' not in disabled_engines),
+        }
+        self.load_dicts()
+
+    def load_pkuseg(self):
+        import pkuseg
+        version = self.cn_dict.version
+        seg = pkuseg.pkuseg(user_dict=sorted(self.cn_dict.words))
+        if self.cn_dict.version != version:
+            # words changed while loading the model
+            seg.preprocesser = pkuseg.Preprocesser(sorted(self.cn_dict.words))
+        return seg
+
+    def load_ckip(self):
+        # importing ckiptagger loads tensorflow
+        from ckiptagger import construct_dictionary, WS
+        ws = BatchedWS(WS('./ckipdata'), batch_size=self.options['ckip_batch_size'],
+                       max_wait=self.options['ckip_batch_wait'])
+        self.ckip_dict_cons = construct_dictionary(self.ckip_dict)
+        return ws
+
+    def load_mecab(self):
+        import MeCab
+        return MeCab.Tagger('-Owakati')
+
+    def warm_up(self):
+        # load enabled engines in a background thread
+        def _warm_up():
+            for engine in self.engines.values():
+                engine.load()
+        threading.Thread(target=_warm_up, name='tokenizer-warm-up', daemon=True).start()
+
+    def update_pkuseg_dict(self, added=None):
+        # apply user dictionary changes to the live segmenter, without reloading its model
+        seg = self.engines['cn'].engine
+        if seg is None:
+            return
+        if added is not None:
+            seg.preprocesser.insert(added, '')
+        else:
+            # words cannot be removed from the trie, so build a new one and switch to it
+            from pkuseg import Preprocesser
+            seg.preprocesser = Preprocesser(sorted(self.cn_dict.words))
+
+    def update_ckip_dict(self):
+        # the constructed dictionary needs ckiptagger, which is only imported with the engine
+        if self.engines['tw'].ready:
+            from ckiptagger import construct_dictionary
+            self.ckip_dict_cons = construct_dictionary(self.ckip_dict)
+
+    def load_dicts(self, dict_version=None):
+        # (re)load user dictionaries from files
+        if dict_version is not None:
+            self.dict_version = dict_version
+        self.cache.clear(self.dict_version)
         self.ckip_dict = {}
         self.ckip_dict_cons = {}
-        # lines per chunk
-        self.chunk_size = 1000
         try:
             with open('./ckip_dict.json') as f:
                 self.ckip_dict = json.load(f)
-            self.ckip_dict_cons = construct_dictionary(self.ckip_dict)
         except:
             pass
-        self.ckip = WS('./ckipdata')
+        self.update_ckip_dict()
+        self.cn_dict.load()
+        self.update_pkuseg_dict()
+
+    def cut_cn(self, text):
+        seg = self.engines['cn'].get()
+        if not seg:
+            return fallback_cut(text)
+        with tokenizer_seconds.time('pkuseg'):
+            return seg.cut(text)
+
+    def parse_jp(self, text):
+        wakati = self.engines['jp'].get()
+        if not wakati:
+            return ' '.join(fallback_cut(text))
+        with tokenizer_seconds.time('mecab'):
+            return wakati.parse(text)
+
+    def cut_tw(self, sentence_list, recommend_dictionary=None, segment_delimiter_set=None):
+        ws = self.engines['tw'].get()
+        if not ws:
+            return [self.cut_cn(sentence) for sentence in sentence_list]
+        # including the wait for other sentences of the batch
+        with tokenizer_seconds.time('ckiptagger'):
+            return ws(sentence_list, recommend_dictionary=self.ckip_dict_cons, segment_delimiter_set=segment_delimiter_set)
+
+    def cld_detect(self, text):
+        reliable, _, details = cld2.detect(text)
+        return (reliable, details)
+
+    def addword_cn(self, word):
+        if not self.cn_dict.add(word):
+            # duplicate
+            return False
+        self.update_pkuseg_dict(added=word)
+        self.dict_version += 1
+        self.cache.clear(self.dict_version)
+        return True
+
+    def addword_tw(self, word):
+        if word in self.ckip_dict:
+            return False
+        self.ckip_dict[word] = 1
+        self.update_ckip_dict()
         try:
-            self.seg = pkuseg.pkuseg(user_dict='./pkuseg_dict.txt')
+            with open('./ckip_dict.json', 'w', encoding='utf-8') as f:
+                json.dump(self.ckip_dict, f)
         except:
-            self.seg = pkuseg.pkuseg()
+            logging.info('addword_tw: failed to write to file')
+        self.dict_version += 1
+        self.cache.clear(self.dict_version)
+        return True
+
+    def rmword_cn(self, word):
+        if not self.cn_dict.remove(word):
+            # not exist
+            return False
+        self.update_pkuseg_dict()
+        self.dict_version += 1
+        self.cache.clear(self.dict_version)
+        return True
+
+    def rmword_tw(self, word):
+        if word not in self.ckip_dict:
+            return False
+        del self.ckip_dict[word]
+        self.update_ckip_dict()
+        try:
+            with open('./ckip_dict.json', 'w', encoding='utf-8') as f:
+                json.dump(self.ckip_dict, f)
+        except:
+            logging.info('addword_tw: failed to write to file')
+        self.dict_version += 1
+        self.cache.clear(self.dict_version)
+        return True
+
+    def cut(self, text):
+        return cut(text, SimpleNamespace(cut=self.cut_cn), self.cut_tw, SimpleNamespace(parse=self.parse_jp), cache=self.cache)
+
+class CorpusModel:
+    def __init__(self, **tokenizer_options):
+        # init model which at least contains something
+        self.chain = MarkovChain()
+        self.chain.add(split_runs('Hello world.\n'))
+        self.path = ''
+        # lines per chunk
+        self.chunk_size = 1000
+        # keywords to try in respond
+        self.max_keywords = 3
+        self.tokenizer = Tokenizer(**tokenizer_options)
+
+    def cut(self, text):
+        return self.tokenizer.cut(text)
+
+    def cld_detect(self, text):
+        return self.tokenizer.cld_detect(text)
+
+    def addword_cn(self, word):
+        return self.tokenizer.addword_cn(word)
+
+    def addword_tw(self, word):
+        return self.tokenizer.addword_tw(word)
+
+    def rmword_cn(self, word):
+        return self.tokenizer.rmword_cn(word)
+
+    def rmword_tw(self, word):
+        return self.tokenizer.rmword_tw(word)
 
     def load(self, path):
         self.path = path
         with open(path) as f:
             for lines in iter(lambda: ''.join(islice(f, self.chunk_size)), ''):
                 if not lines.strip(): continue
-                model = markovify.NewlineText(lines, retain_original=False, well_formed=False)
-                if self.model:
-                    self.model = markovify.append(self.model, [model])
-                else:
-                    self.model = model
+                self.chain.add(split_runs(lines))
 
     def save(self, path):
-        model_json = self.model.chain.to_json()
+        # same format as markovify.Chain.to_json()
+        model_json = json.dumps(list(self.chain.items()), ensure_ascii=False)
         with open(path, 'w', encoding='utf-8') as f:
             json.dump(model_json, f, ensure_ascii=False)
 
-    def load_db(self, path):
-        import sqlite3
+    def load_db(self, path, snapshot_path=''):
+        '''
+        Load the chain from a snapshot if it matches the db, then replay the
+        corpus rows added after it. Without a usable snapshot, all rows are fed.
+        return: True if the snapshot was used
+        '''
         conn = sqlite3.connect(path)
         with conn:
             cursor = conn.cursor()
-            lines_db = cursor.execute("SELECT corpus_line, corpus_weight FROM corpus")
+            watermark = 0
+            use_snapshot = False
+            if snapshot_path and isfile(snapshot_path):
+                try:
+                    chain, watermark, checksum = read_snapshot(snapshot_path)
+                    if corpus_checksum(cursor, watermark) != checksum:
+                        raise ValueError('corpus has changed since the snapshot')
+                    self.chain = chain
+                    use_snapshot = True
+                    logging.info(f'load_db: loaded snapshot with {len(chain.table)} states, watermark: {watermark}')
+                except (OSError, ValueError) as e:
+                    logging.info(f'load_db: snapshot not used: {e}')
+                    watermark = 0
+            lines_db = cursor.execute("""
+                SELECT corpus_line, corpus_weight FROM corpus
+                WHERE corpus_id > ? ORDER BY corpus_id
+                """, (watermark,))
             while True:
                 rst = lines_db.fetchmany(self.chunk_size)
                 if not rst:
                     break
                 [lines, weights] = zip(*rst)
-                models = list(map(lambda l: markovify.Text(l, retain_original=False, well_formed=False), lines))
-                self.model = markovify.append(self.model, models, weights=weights)
+                self.feed(lines, weight=weights)
+        conn.close()
+        return use_snapshot
+
+    def rebuild_from_db(self, path, until):
+        '''
+        Build a new chain from the corpus rows with corpus_id up to `until`.
+        The current chain is not touched, pass the new one to replace_chain().
+        '''
+        chain = MarkovChain()
+        chain.add(split_runs('Hello world.\n'))
+        conn = sqlite3.connect(path)
+        lines_db = conn.execute("""
+            SELECT corpus_line, corpus_weight FROM corpus
+            WHERE corpus_id <= ? ORDER BY corpus_id
+            """, (until,))
+        while True:
+            rst = lines_db.fetchmany(self.chunk_size)
+            if not rst:
+                break
+            for line, weight in rst:
+                chain.add(split_runs(line, newline=False), weight)
+        conn.close()
+        return chain
+
+    def replace_chain(self, chain, lines=(), weights=()):
+        # switch to chain, after feeding it the lines added since it was built
+        chain.background_merges = self.chain.background_merges
+        feed_chain(chain, lines, weights)
+        self.chain = chain
+
+    def save_snapshot(self, path, db_path):
+        # the snapshot is valid for the current content of the corpus table
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT IFNULL(MAX(corpus_id), 0) FROM corpus")
+        watermark, = cursor.fetchone()
+        checksum = corpus_checksum(cursor, watermark)
+        conn.close()
+        write_snapshot(path, self.chain, watermark, checksum)
 
     def load_json(self, path):
-        raw = open(path).read()
-        self.model = Text.from_json(raw)
+        with open(path, encoding='utf-8') as f:
+            obj = json.load(f)
+        # `save` writes the chain json as a json string
+        if isinstance(obj, str):
+            obj = json.loads(obj)
+        self.chain.add_transitions(obj)
 
     def cut_lines(self, text, tokens=None):
         if not tokens:
@@ -157,93 +677,101 @@ class CorpusModel:
         if weight is None:
             weight = 1.
         if type(weight) in (int, float):
-            incoming_model = markovify.NewlineText('\n'.join(lines), retain_original=False, well_formed=False)
-            weight = (weight,)
-            self.model = markovify.append(self.model, [incoming_model], weights=weight)
+            self.chain.add(split_runs('\n'.join(lines)), weight)
             return
-        self.model = markovify.append(self.model, list(map(lambda l: markovify.Text(l, retain_original=False, well_formed=False), lines)), weights=weight)
+        for line, w in zip(lines, weight):
+            self.chain.add(split_runs(line, newline=False), w)
 
     def erase(self, lines, weight=None):
         if weight is None:
             weight = -1.
-        if type(weight) in (int, float):
-            incoming_model = markovify.NewlineText('\n'.join(lines), retain_original=False, well_formed=False)
-            weight = (weight,)
-            self.model = markovify.append(self.model, [incoming_model], weights=weight)
-            return
-        self.model = markovify.append(self.model, list(map(lambda l: markovify.Text(l, retain_original=False, well_formed=False), lines)), weights=weight)
+        self.feed(lines, weight=weight)
 
-    def cld_detect(self, text):
-        reliable, _, details = cld2.detect(text)
-        return (reliable, details)
+    def _take(self, token_ids, vocab, max_chars=None, deadline=None, backward=False):
+        '''
+        Take tokens of a walk while they fit in `max_chars` (counting a space after
+        each) and `deadline` (of time.monotonic()) has not passed, so the rest of
+        the walk is never generated. If stopped early, end at the last sentence
+        ender taken, or start after it if `backward`.
+        token_ids: iterator of token ids, nearest first if `backward`
+        return: tokens, in the order of token_ids
+        '''
+        rst = []
+        size = 0
+        ender = None
+        for token_id in token_ids:
+            token = vocab[token_id]
+            size += len(token) + 1
+            if (max_chars is not None and size > max_chars) or (deadline is not None and time.monotonic() > deadline):
+                return rst[:ender] if ender is not None else rst
+            rst.append(token)
+            if token[-1] in ENDER_PUNCT_LIST + ENDER_PUNCT_TRAILING_SPACE_LIST:
+                ender = len(rst) - 1 if backward else len(rst)
+        return rst
 
-    def addword_cn(self, word):
-        try:
-            cur_dict = open('./pkuseg_dict.txt').readlines()
-            if word + '\n' in cur_dict:
-                # duplicate
-                return False
-        except:
-            return False
-        with open('./pkuseg_dict.txt', 'a') as f:
-            f.write(word + '\n')
-        del self.seg
-        self.seg = pkuseg.pkuseg(user_dict='./pkuseg_dict.txt')
-        return True
+    # the following use `chain` if given, such as a per-chat chain, instead of the model's
 
-    def addword_tw(self, word):
-        if word in self.ckip_dict:
-            return False
-        self.ckip_dict[word] = 1
-        self.ckip_dict_cons = construct_dictionary(self.ckip_dict)
-        try:
-            with open('./ckip_dict.json', 'w', encoding='utf-8') as f:
-                json.dump(self.ckip_dict, f)
-        except:
-            logging.info('addword_tw: failed to write to file')
-        return True
+    def make_sentence(self, chain=None, max_chars=None, deadline=None):
+        chain = chain if chain is not None else self.chain
+        return ' '.join(self._take(chain.iter_walk(), chain.vocab, max_chars, deadline))
 
-    def rmword_cn(self, word):
-        try:
-            cur_dict = open('./pkuseg_dict.txt').readlines()
-            if word + '\n' not in cur_dict:
-                # not exist
-                return False
-        except:
-            return False
-        cur_dict = [w for w in cur_dict if word+'\n' != w]
-        with open('./pkuseg_dict.txt', 'w') as f:
-            f.write(''.join(cur_dict))
-        self.seg = pkuseg.pkuseg(user_dict='./pkuseg_dict.txt')
-        return True
+    def make_sentence_that_contains(self, keyword, chain=None, max_chars=None, deadline=None):
+        chain = chain if chain is not None else self.chain
+        token_id = chain.vocab.get(keyword)
+        if token_id is None:
+            raise KeyError(keyword)
+        # walk in both directions from a random state containing the keyword
+        key = chain.random_state_with(token_id)
+        state = [chain.vocab[t] for t in chain.unpack(key) if t != BEGIN_ID]
+        if max_chars is not None:
+            max_chars = max(max_chars - sum(len(tok) + 1 for tok in state), 0)
+        # up to half of the budget before the state, so that the keyword is not at the very end
+        back = self._take(chain.iter_walk_back(key), chain.vocab,
+            max_chars // 2 if max_chars is not None else None, deadline, backward=True)
+        back.reverse()
+        if max_chars is not None:
+            max_chars -= sum(len(tok) + 1 for tok in back)
+        forward = self._take(chain.iter_walk(key), chain.vocab, max_chars, deadline)
+        return ' '.join(back + state + forward)
 
-    def rmword_tw(self, word):
-        if word not in self.ckip_dict:
-            return False
-        del self.ckip_dict[word]
-        self.ckip_dict_cons = construct_dictionary(self.ckip_dict)
-        try:
-            with open('./ckip_dict.json', 'w', encoding='utf-8') as f:
-                json.dump(self.ckip_dict, f)
-        except:
-            logging.info('addword_tw: failed to write to file')
-        return True
+    def keyword_candidates(self, words, chain=None):
+        # return: known words, rarest first
+        chain = chain if chain is not None else self.chain
+        vocab = chain.vocab
+        counts = {}
+        for word in set(words):
+            token_id = vocab.get(word)
+            if token_id is not None:
+                counts[word] = chain.count_states(token_id)
+        return sorted((w for w in counts if counts[w]), key=counts.get)
 
-    def cut(self, text):
-        return cut(text, self.seg, self.ckip, self.wakati, tw_dict=self.ckip_dict_cons)
+    def make_sentences(self, count, chain=None, max_chars=None, deadline=None):
+        # several sentences at once, see MarkovChain.walk_many()
+        chain = chain if chain is not None else self.chain
+        # a token takes at least two characters with its space, so walks cut short are over the budget
+        max_steps = max_chars // 2 + 1 if max_chars is not None else None
+        return [' '.join(self._take(iter(walk), chain.vocab, max_chars))
+                for walk in chain.walk_many(count, max_steps=max_steps, deadline=deadline)]
 
-    def generate(self):
-        return join(self.model.make_sentence())
+    def generate(self, chain=None, max_chars=None, deadline=None):
+        return join(self.make_sentence(chain, max_chars, deadline))
 
-    def respond(self, text, tokens=None):
+    def generate_many(self, count, chain=None, max_chars=None, deadline=None):
+        return [join(sentence) for sentence in self.make_sentences(count, chain, max_chars, deadline)]
+
+    def respond(self, text, tokens=None, chain=None, max_chars=None, deadline=None):
+        # `chain` is tried first, then the model's
         if not tokens:
             tokens = self.cut(text)
         words = [tok for tok in tokens if tok not in FULL_PUNCT_LIST]
         if not words:
             return ''
-        keyword = random.choice(words)
-        try:
-            return join(self.model.make_sentence_that_contains(keyword))
-        except (IndexError, markovify.text.ParamError, KeyError):
-            return ''
-
+        for c in ([chain] if chain is not None else []) + [self.chain]:
+            for keyword in self.keyword_candidates(words, c)[:self.max_keywords]:
+                if deadline is not None and time.monotonic() > deadline:
+                    return ''
+                try:
+                    return join(self.make_sentence_that_contains(keyword, c, max_chars, deadline))
+                except (IndexError, KeyError):
+                    continue
+        return ''
@@ -0,0 +1,234 @@
+'''
+Counters, gauges and latency histograms, rendered in the Prometheus text format.
+
+Modules register their metrics in `registry` when imported. Updating a metric
+is a dict update under a lock, cheap enough to leave on in production.
+Worker processes send their updates to the main process with collect() and merge().
+'''
+import os
+import time
+import bisect
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30.)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # label values: value
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def label_str(self, label_values, extra=()):
+        pairs = list(zip(self.labels, label_values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+    def collect(self):
+        # return: updates since the last collect(), and forget them
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def items(self):
+        with self.lock:
+            return sorted(self.values.items())
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self.values.get(label_values, 0)
+
+    def merge(self, values):
+        with self.lock:
+            for label_values, value in values.items():
+                self.values[label_values] = self.values.get(label_values, 0) + value
+
+    def samples(self):
+        for label_values, value in self.items():
+            yield self.name, self.label_str(label_values), value
+
+class Gauge(Metric):
+    '''
+    Value computed by `func` when rendered,
+    or a dict from label values to values if the gauge has labels.
+    '''
+    type = 'gauge'
+
+    def __init__(self, name, help, func, labels=()):
+        super().__init__(name, help, labels)
+        self.func = func
+
+    def samples(self):
+        try:
+            values = self.func()
+        except Exception:
+            logging.exception(f'Failed to get {self.name}')
+            return
+        if not self.labels:
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            if not isinstance(label_values, tuple):
+                label_values = (label_values,)
+            yield self.name, self.label_str(label_values), value
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            h = self.values.get(label_values)
+            if h is None:
+                # counts of each bucket (not cumulative), sum, count
+                h = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0., 0]
+            h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        # observe the seconds spent in the with block, also around awaits
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def merge(self, values):
+        with self.lock:
+            for label_values, (counts, total, count) in values.items():
+                h = self.values.get(label_values)
+                if h is None:
+                    h = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0., 0]
+                h[0] = [a + b for a, b in zip(h[0], counts)]
+                h[1] += total
+                h[2] += count
+
+    def quantile(self, q, *label_values):
+        # upper bound of the bucket holding the q-quantile
+        h = self.values.get(label_values)
+        if not h or not h[2]:
+            return 0.
+        rank = q * h[2]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), h[0]):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def items(self):
+        with self.lock:
+            return sorted((label_values, (list(counts), total, count))
+                          for label_values, (counts, total, count) in self.values.items())
+
+    def samples(self):
+        for label_values, (counts, total, count) in self.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', self.label_str(label_values, [('le', _format_value(bound))]), cumulative
+            yield f'{self.name}_sum', self.label_str(label_values), total
+            yield f'{self.name}_count', self.label_str(label_values), count
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        # metrics of the same name are shared, e.g. when a module is reloaded
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, func, labels=()):
+        return self._register(Gauge(name, help, func, labels))
+
+    def render(self):
+        # return: all metrics in the Prometheus text format
+        out = []
+        for metric in self.metrics.values():
+            out.append(f'# HELP {metric.name} {metric.help}')
+            out.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                out.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(out) + '\n'
+
+    def collect(self):
+        # return: {name: updates} of counters and histograms since the last collect()
+        return {name: metric.collect() for name, metric in self.metrics.items()
+                if not isinstance(metric, Gauge) and metric.values}
+
+    def merge(self, updates):
+        for name, values in updates.items():
+            metric = self.metrics.get(name)
+            if metric is not None:
+                metric.merge(values)
+
+    def reset(self):
+        for metric in self.metrics.values():
+            if not isinstance(metric, Gauge):
+                metric.collect()
+
+registry = Registry()
+
+def resident_memory():
+    # return: resident memory of this process in bytes, 0 if unknown
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+registry.gauge('process_resident_memory_bytes', 'Resident memory of the main process', resident_memory)
+
+async def serve(host, port, registry=registry):
+    '''
+    Serve `registry` over HTTP in the Prometheus text format, on any path.
+    return: the asyncio server
+    '''
+    async def handle(reader, writer):
+        try:
+            # request line and headers, which are not used
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass
+            body = registry.render().encode('utf-8')
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,175 @@
+import time
+import asyncio
+import logging
+import sqlite3
+from pathlib import Path
+from collections import OrderedDict
+from markov import build_chain, feed_chain
+from metrics import registry
+
+def corpus_watermark(cursor):
+    # runs in the db writer, its result is given once the lines submitted before it are committed
+    # return: max corpus_id
+    cursor.execute("SELECT IFNULL(MAX(corpus_id), 0) FROM corpus")
+    return cursor.fetchone()[0]
+
+def read_chat_lines(path, chat, watermark, limit):
+    # runs in a thread, on a read-only connection of its own instead of the db writer
+    # return: the last `limit` (corpus_line, corpus_weight) of the chat up to watermark, oldest first
+    conn = sqlite3.connect(Path(path).absolute().as_uri() + '?mode=ro', uri=True)
+    try:
+        rows = conn.execute("""
+            SELECT corpus_line, corpus_weight FROM corpus
+            WHERE corpus_chat = ? AND corpus_id <= ?
+            ORDER BY corpus_id DESC
+            LIMIT ?
+            """, (chat, watermark, limit)).fetchall()
+    finally:
+        conn.close()
+    return rows[::-1]
+
+class Partition:
+    def __init__(self, epoch):
+        self.epoch = epoch
+        # None while loading
+        self.chain = None
+        # (lines, weights) fed while loading
+        self.pending = []
+        self.line_count = 0
+        self.last_used = time.monotonic()
+
+class ChatPartitions:
+    '''
+    Per-chat chains of group chats, tried before the global chain of the model.
+
+    The partition of a chat holds its last `max_lines` corpus lines. It is loaded
+    in the background on first use, from a read-only connection instead of the db
+    writer. Chats with fewer than `min_lines` lines get no chain, and are only
+    counted until they have enough of them. At most `max_chats` partitions
+    holding at most `max_bytes` of chains are kept, the least recently used ones
+    are evicted, and so are partitions not used for `idle_seconds`. A partition
+    grown past twice `max_lines` is evicted too, and loaded again on next use.
+
+    Each load of a partition has its own epoch. New lines are fed with the epoch
+    they saw before being written, since lines written earlier than a load are
+    read by the load itself.
+    '''
+    def __init__(self, db, max_chats=16, max_lines=100000, min_lines=1000, idle_seconds=3600, max_bytes=256 * 2**20):
+        self.db = db
+        self.max_chats = max_chats
+        self.max_lines = max_lines
+        self.min_lines = min_lines
+        self.idle_seconds = idle_seconds
+        self.max_bytes = max_bytes
+        # corpus_chat: Partition, least recently used first
+        self.partitions = OrderedDict()
+        # corpus_chat: line count of chats with too few lines, least recently used first
+        self.small = OrderedDict()
+        self.max_small = 1000
+        self.next_epoch = 1
+        registry.gauge('partitions', 'Loaded per-chat partitions', lambda: len(self.partitions))
+        registry.gauge('partition_lines', 'Lines in loaded per-chat partitions',
+            lambda: sum(p.line_count for p in self.partitions.values()))
+        registry.gauge('partition_bytes', 'Rough memory usage of the chains of per-chat partitions', self.nbytes)
+
+    def epoch(self, chat):
+        # call before writing new lines of the chat, and pass the result to feed()
+        partition = self.partitions.get(chat)
+        return partition.epoch if partition else None
+
+    def get(self, chat, group=True):
+        # return: chain of the chat, None if it's not usable (yet)
+        if self.max_chats <= 0 or not group:
+            return None
+        self.evict_idle()
+        if chat in self.small:
+            self.small.move_to_end(chat)
+            return None
+        partition = self.partitions.get(chat)
+        if partition is None:
+            partition = self.partitions[chat] = Partition(self.next_epoch)
+            self.next_epoch += 1
+            # submitted right away, before any write seeing the new epoch
+            watermark = self.db.submit(corpus_watermark)
+            asyncio.ensure_future(self.load(chat, partition, watermark))
+            self.evict()
+            return None
+        partition.last_used = time.monotonic()
+        self.partitions.move_to_end(chat)
+        if partition.chain is None or partition.line_count < self.min_lines:
+            return None
+        return partition.chain
+
+    async def load(self, chat, partition, watermark):
+        # watermark: future of corpus_watermark()
+        start = time.monotonic()
+        try:
+            watermark = await asyncio.wrap_future(watermark)
+            loop = asyncio.get_event_loop()
+            rows = await loop.run_in_executor(None, read_chat_lines, self.db.path, chat, watermark, self.max_lines)
+            chain = None
+            line_count = len(rows) + sum(len(lines) for lines, _ in partition.pending)
+            if line_count >= self.min_lines:
+                chain = await loop.run_in_executor(None, build_chain, rows)
+        except Exception:
+            logging.exception(f'partitions: failed to load chat {chat}')
+            if self.partitions.get(chat) is partition:
+                del self.partitions[chat]
+            return
+        if self.partitions.get(chat) is not partition:
+            # evicted or cleared while loading
+            return
+        if chain is None:
+            del self.partitions[chat]
+            self.small[chat] = line_count
+            while len(self.small) > self.max_small:
+                self.small.popitem(last=False)
+            return
+        partition.line_count = len(rows)
+        for lines, weights in partition.pending:
+            feed_chain(chain, lines, weights)
+            partition.line_count += len(lines)
+        partition.chain = chain
+        partition.pending = None
+        logging.info(f'partitions: loaded chat {chat}, {partition.line_count} lines in {time.monotonic() - start:.1f}s')
+        self.evict()
+
+    def feed(self, chat, lines, weights, epoch):
+        if chat in self.small:
+            self.small[chat] += len(lines)
+            if self.small[chat] >= self.min_lines:
+                # loaded on next use
+                del self.small[chat]
+            return
+        partition = self.partitions.get(chat)
+        if partition is None or partition.epoch != epoch:
+            # not loaded, or the lines are read by the load
+            return
+        if partition.chain is None:
+            partition.pending.append((lines, weights))
+            return
+        feed_chain(partition.chain, lines, weights)
+        partition.line_count += len(lines)
+        if partition.line_count > 2 * self.max_lines:
+            del self.partitions[chat]
+
+    def nbytes(self):
+        return sum(p.chain.nbytes() for p in self.partitions.values() if p.chain is not None)
+
+    def evict(self):
+        # the most recently used partition is kept, even if it's larger than max_bytes alone
+        while len(self.partitions) > 1 and (len(self.partitions) > self.max_chats or self.nbytes() > self.max_bytes):
+            self.partitions.popitem(last=False)
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_seconds
+        while self.partitions:
+            chat, partition = next(iter(self.partitions.items()))
+            if partition.last_used >= deadline:
+                break
+            del self.partitions[chat]
+
+    def clear(self):
+        # lines have been changed or erased, partitions are loaded again when used
+        self.partitions.clear()
+        self.small.clear()
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import weakref
+from collections import deque
+from markov import join
+from metrics import registry
+
+pool_requests = registry.counter('sentence_pool_requests_total', 'Sentences asked from the pool', ['result'])
+
+class SentencePool:
+    '''
+    Sentences generated ahead of time, for replies which don't depend on the message.
+
+    Each chain asked for (the global one, and per-chat partitions) has a pool of at
+    most `size` sentences, generated `batch` at a time with make_sentences() in the
+    workers. Pools are refilled in the background when no other worker job is
+    running, and go away with their chains when these are replaced or evicted.
+    A sentence is served once, and may be asked for by a token it contains.
+    '''
+    def __init__(self, workers, model, size=32, batch=8, idle_wait=0.05):
+        self.workers = workers
+        self.model = model
+        self.size = size
+        self.batch = batch
+        self.idle_wait = idle_wait
+        # length limit of sentences, can be changed at any time
+        self.max_chars = None
+        # chain: deque of (sentence, set of tokens)
+        self.pools = weakref.WeakKeyDictionary()
+        # batches generated before clear() are dropped
+        self.version = 0
+        self.task = None
+        self.wake = None
+        registry.gauge('sentence_pool_sentences', 'Sentences in the pools',
+            lambda: sum(len(pool) for pool in list(self.pools.values())))
+
+    def fits(self, sentence):
+        return self.max_chars is None or len(sentence) <= self.max_chars
+
+    def get(self, chain, token=None):
+        # return: a sentence of the chain, containing `token` if given, None if there is none yet
+        if self.size <= 0:
+            return None
+        pool = self.pools.get(chain)
+        if pool is None:
+            pool = self.pools[chain] = deque(maxlen=self.size)
+        rst = None
+        for i, (sentence, tokens) in enumerate(pool):
+            if (token is None or token in tokens) and self.fits(sentence):
+                rst = sentence
+                del pool[i]
+                break
+        pool_requests.inc('hit' if rst else 'miss')
+        # started on first use, in the running loop
+        if self.task is None:
+            self.wake = asyncio.Event()
+            self.task = asyncio.ensure_future(self._run())
+        self.wake.set()
+        return rst
+
+    async def _run(self):
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            while await self._refill_one():
+                pass
+
+    async def _refill_one(self):
+        # return: False if all pools are full, or nothing could be added until the next get()
+        ## chains are only referenced in here, so that they can go away between refills
+        pools = [(len(pool), chain) for chain, pool in list(self.pools.items()) if len(pool) < self.size]
+        if not pools:
+            return False
+        # the emptiest pool first
+        chain = min(pools, key=lambda p: p[0])[1]
+        del pools
+        while self.workers.running:
+            await asyncio.sleep(self.idle_wait)
+        version = self.version
+        try:
+            sentences = await self.workers.run(self.model.make_sentences, self.batch, chain, self.max_chars)
+        except Exception:
+            logging.exception('pool: failed to generate sentences')
+            return False
+        pool = self.pools.get(chain)
+        if pool is not None and version == self.version:
+            pool.extend((join(sentence), set(sentence.split(' '))) for sentence in sentences if sentence)
+        # a chain walking to empty sentences only, such as an empty one
+        return any(sentences)
+
+    def clear(self):
+        # lines have been erased, which pooled sentences may come from
+        self.pools.clear()
+        self.version += 1
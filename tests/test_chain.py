@@ -0,0 +1,78 @@
+import sys
+import random
+import threading
+from chain import MarkovChain
+
+def make_lines(count, seed=0):
+    rng = random.Random(seed)
+    words = [f'w{i}' for i in range(2000)]
+    return [[rng.choice(words) for _ in range(rng.randint(1, 8))] for _ in range(count)]
+
+def test_feed_while_walking():
+    # walks in threads read delta while it's fed and erased on this one
+    chain = MarkovChain()
+    chain.min_merge_size = 200
+    chain.background_merges = True
+    chain.add(make_lines(100))
+    errors = []
+    # switch threads often, so that walks see states in the middle of changes
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    stop = threading.Event()
+
+    def walk():
+        try:
+            while not stop.is_set():
+                chain.walk()
+                chain.walk_many(4, max_steps=10)
+                chain.successors(chain.begin_key)
+                key = chain.pack([random.randrange(2, 2002), random.randrange(2, 2002)])
+                chain.predecessors(key)
+                chain.is_live(key)
+                try:
+                    chain.random_state_with(random.randrange(2, 2002))
+                except KeyError:
+                    pass
+                list(chain.keys())
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=walk) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        for i in range(300):
+            lines = make_lines(20, seed=i + 1)
+            chain.add(lines)
+            if i % 3 == 0:
+                chain.add(lines, -1.)
+    finally:
+        sys.setswitchinterval(interval)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    assert not errors, errors
+
+def test_erase_adds_up():
+    # weights erased past 0 are kept until fed again, like summing markovify models
+    chain = MarkovChain()
+    chain.min_merge_size = 50
+    pool = make_lines(100)
+    expected = {}
+    shift = chain.bits * (chain.state_size - 1)
+    rng = random.Random(1)
+    for i in range(2000):
+        line = rng.choice(pool)
+        weight = rng.choice([1., -1.])
+        chain.add([line], weight)
+        key = chain.begin_key
+        for token_id in [chain.vocab.intern(tok) for tok in line] + [1]:
+            expected[key, token_id] = expected.get((key, token_id), 0.) + weight
+            key = (key >> chain.bits) | (token_id << shift)
+        if i % 300 == 0:
+            chain.merge()
+    chain.merge()
+    for (key, token_id), weight in expected.items():
+        assert chain.weight(key, token_id) == weight
+        if weight > 0:
+            assert token_id in chain.successors(key)[0]
@@ -0,0 +1,60 @@
+import sqlite3
+import pytest
+import database
+from database import Database
+
+class FailingConnection(sqlite3.Connection):
+    # fails the next `failures` commits
+    failures = 0
+
+    def commit(self):
+        if FailingConnection.failures:
+            FailingConnection.failures -= 1
+            raise sqlite3.OperationalError('disk I/O error')
+        super().commit()
+
+def connect(path):
+    conn = sqlite3.connect(path, factory=FailingConnection)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    path = str(tmp_path / 'test.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE t (x INTEGER)')
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(database, 'connect', connect)
+    db = Database(path, commit_interval=0.01)
+    yield db
+    db.close()
+
+def insert(cursor, *values):
+    for x in values:
+        cursor.execute('INSERT INTO t VALUES (?)', (x,))
+    return len(values)
+
+def fail_after_insert(cursor):
+    cursor.execute('INSERT INTO t VALUES (100)')
+    raise ValueError('failed')
+
+def rows(db):
+    return sorted(x for x, in db.reader.execute('SELECT x FROM t'))
+
+def test_failed_job_leaves_no_writes(db):
+    futures = [db.submit(insert, 1), db.submit(fail_after_insert), db.submit(insert, 2, 3)]
+    assert futures[0].result() == 1
+    with pytest.raises(ValueError):
+        futures[1].result()
+    assert futures[2].result() == 2
+    assert rows(db) == [1, 2, 3]
+
+def test_failed_commit_fails_its_jobs(db):
+    FailingConnection.failures = 1
+    failed = db.submit(insert, 1)
+    with pytest.raises(sqlite3.OperationalError):
+        failed.result(timeout=5)
+    # the writer goes on
+    assert db.submit(insert, 2).result(timeout=5) == 1
+    assert rows(db) == [2]
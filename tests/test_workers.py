@@ -0,0 +1,25 @@
+import asyncio
+from types import SimpleNamespace
+from workers import WorkerPool
+
+def test_concurrent_cuts_are_batched():
+    pool = WorkerPool(tokenizer_options={'ckip_batch_size': 4, 'ckip_batch_wait': 0.05})
+    pool.model = SimpleNamespace(cut=lambda text: text.split(' '))
+    batches = []
+    cut_many = pool.cut_many
+
+    async def record(texts, timeout=None):
+        batches.append(list(texts))
+        return await cut_many(texts, timeout)
+
+    pool.cut_many = record
+
+    async def main():
+        return await asyncio.gather(*(pool.cut(f'a {i}') for i in range(6)))
+
+    try:
+        assert asyncio.run(main()) == [['a', str(i)] for i in range(6)]
+    finally:
+        pool.shutdown()
+    # a full batch is sent right away, the rest after the wait
+    assert batches == [[f'a {i}' for i in range(4)], ['a 4', 'a 5']]
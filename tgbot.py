@@ -1,15 +1,25 @@
 import re
+import time
 import config
+import asyncio
 import logging
-import sqlite3
-import tempfile
 from time import mktime
+from io import BytesIO
 from os.path import isfile
 from importlib import reload
-from markov import CorpusModel
+from functools import partial
+from markov import CorpusModel, FULL_PUNCT_LIST
+from workers import WorkerPool
+from database import Database, HashFilter, content_hash, init_db
+from wordclouds import WordClouds
+from chatlog import ChatLog
+from partitions import ChatPartitions
+from pool import SentencePool
+from metrics import registry, resident_memory, serve as serve_metrics
 from wordcloud import WordCloud
 from telethon import TelegramClient, events
 from numpy import random
+from collections import deque
 
 logging.basicConfig(level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -31,49 +41,140 @@ USER_RIGHT_LEVEL_NAME = {
     USER_RIGHT_LEVEL_ROOT:       'root',
 }
 
-COMMAND_LIST = (
-    '/addword',
-    '/addword_cn',
-    '/addword_tw',
-    '/ban',
-    '/clddbg',
-    '/cutdbg',
-    '/erase',
-    '/grantadmin',
-    '/grantnormal',
-    '/granttrusted',
-    '/policy',
-    '/reload',
-    '/reload_config',
-    '/restrict',
-    '/rmword',
-    '/rmword_cn',
-    '/rmword_tw',
-    '/source',
-    '/start',
-    '/userweight',
-    '/wordcloud',
-    '/reprocessraw',
-)
-
-conn = sqlite3.connect(config.dbfile)
-cursor = conn.cursor()
+class OwnMessages:
+    '''
+    Ids of messages sent by the bot, to tell replies to the bot without fetching the replied message.
+    In each chat, all messages sent since `since[chat_id]` are known, as long as they are
+    among the last `size` messages sent in the chat.
+    '''
+    def __init__(self, size=1000):
+        self.size = size
+        # chat_id: (set of ids, ids in the order they are sent)
+        self.ids = {}
+        self.since = {}
+
+    def observe(self, chat_id, msg_id):
+        # messages sent in the chat from now on have larger ids than msg_id
+        self.since.setdefault(chat_id, msg_id)
+
+    def add(self, chat_id, msg_id):
+        self.observe(chat_id, msg_id)
+        ids, order = self.ids.setdefault(chat_id, (set(), deque()))
+        if msg_id in ids:
+            return
+        ids.add(msg_id)
+        order.append(msg_id)
+        if len(order) > self.size:
+            evicted = order.popleft()
+            ids.discard(evicted)
+            self.since[chat_id] = max(self.since[chat_id], evicted + 1)
+
+    def is_own(self, chat_id, msg_id):
+        # return: whether msg_id is sent by the bot, None if unknown
+        since = self.since.get(chat_id)
+        if since is None or msg_id < since:
+            return None
+        return msg_id in self.ids.get(chat_id, ((),))[0]
+
+own_messages = OwnMessages(config.own_message_cache_size if hasattr(config, 'own_message_cache_size') else 1000)
+
+telegram_request_seconds = registry.histogram('telegram_request_seconds', 'Time of Telegram API requests', ['request'])
+
+class Bot(TelegramClient):
+    # TelegramClient recording ids of sent messages in `own_messages`, and timing API requests
+    ## event.respond(), event.reply() and sending with file= all end up here
+    async def __call__(self, request, *args, **kwargs):
+        with telegram_request_seconds.time(type(request).__name__):
+            return await super().__call__(request, *args, **kwargs)
+
+    async def send_message(self, *args, **kwargs):
+        message = await super().send_message(*args, **kwargs)
+        self._record(message)
+        return message
+
+    async def send_file(self, *args, **kwargs):
+        message = await super().send_file(*args, **kwargs)
+        self._record(message)
+        return message
+
+    def _record(self, messages):
+        for message in (messages if isinstance(messages, list) else [messages]):
+            if message:
+                own_messages.add(message.chat_id, message.id)
 
 if config.proxy:
     import socks
-    bot = TelegramClient(config.session_name, config.api_id, config.api_hash,
+    bot = Bot(config.session_name, config.api_id, config.api_hash,
                             proxy=(socks.SOCKS5, config.proxy_ip, config.proxy_port)).start(bot_token=config.bot_token)
 else:
-    bot = TelegramClient(config.session_name, config.api_id, config.api_hash).start(bot_token=config.bot_token)
+    bot = Bot(config.session_name, config.api_id, config.api_hash).start(bot_token=config.bot_token)
 
 bot_name = config.bot_name
 escaped_bot_name = re.escape(bot_name)
 
+tokenizer_options = {
+    'ckip_batch_size': config.ckip_batch_size if hasattr(config, 'ckip_batch_size') else 64,
+    'ckip_batch_wait': config.ckip_batch_wait if hasattr(config, 'ckip_batch_wait') else 0.005,
+    'segment_cache_size': config.segment_cache_size if hasattr(config, 'segment_cache_size') else 10000,
+    'disabled_engines': config.disabled_engines if hasattr(config, 'disabled_engines') else (),
+}
+
+tokenizer_warm_up = config.tokenizer_warm_up if hasattr(config, 'tokenizer_warm_up') else True
+
+# worker processes are forked here, before the model is loaded
+logging.info('Starting workers...')
+workers = WorkerPool(
+    processes=config.worker_processes if hasattr(config, 'worker_processes') else 0,
+    threads=config.worker_threads if hasattr(config, 'worker_threads') else 4,
+    max_pending=config.worker_max_pending if hasattr(config, 'worker_max_pending') else 64,
+    timeout=config.worker_timeout if hasattr(config, 'worker_timeout') else 30.,
+    tokenizer_options=tokenizer_options,
+    warm_up=tokenizer_warm_up)
+
+# writes go through the writer thread of `db`, `cursor` is for reads only
+## the writer thread is started after worker processes are forked
+db = Database(config.dbfile,
+    commit_interval=config.db_commit_interval if hasattr(config, 'db_commit_interval') else 0.05,
+    commit_size=config.db_commit_size if hasattr(config, 'db_commit_size') else 1000)
+cursor = db.reader.cursor()
+
+# in-memory filter of corpus line hashes, only used in the db writer
+## lines not in the filter are new for sure, and need no lookup for duplicates
+line_filter = None
+use_line_filter = config.dedup_filter if hasattr(config, 'dedup_filter') else True
+
+def load_line_filter(cursor):
+    global line_filter
+    cursor.execute("SELECT COUNT(*) FROM corpus")
+    count, = cursor.fetchone()
+    line_filter = HashFilter(max(2 * count, 100000))
+    cursor.execute("SELECT corpus_hash FROM corpus")
+    while True:
+        rows = cursor.fetchmany(100000)
+        if not rows:
+            break
+        line_filter.add_many([r[0] for r in rows])
+
+def add_to_line_filter(cursor, hashes):
+    if line_filter is None:
+        return
+    line_filter.add_many(hashes)
+    if line_filter.full():
+        load_line_filter(cursor)
+
+db.submit(init_db).result()
+if use_line_filter:
+    db.submit(load_line_filter)
+
 logging.info('Initializing corpus model...')
-model = CorpusModel()
+model = CorpusModel(**tokenizer_options)
+workers.model = model
+snapshot_path = config.snapshot_path if hasattr(config, 'snapshot_path') else ''
 if isfile(config.dbfile):
     logging.info('Loading corpora from db file...')
-    model.load_db(config.dbfile)
+    if not model.load_db(config.dbfile, snapshot_path) and snapshot_path:
+        logging.info('Writing model snapshot...')
+        model.save_snapshot(snapshot_path, config.dbfile)
 elif isfile('./lines.txt'):
     logging.info('Loading corpora from txt file...')
     model.load('./lines.txt')
@@ -82,6 +183,28 @@ elif isfile('./corpora.json'):
     model.load_json('./corpora.json')
 else:
     logging.info('Corpora file not found. Starting from scratch.')
+# the chain is fed on the event loop from now on
+model.chain.background_merges = True
+
+registry.gauge('model_states', 'States in the compact table and the delta of the chain',
+    lambda: {'table': len(model.chain.table), 'delta': len(model.chain.delta)}, ['part'])
+registry.gauge('model_tokens', 'Tokens in the vocabulary', lambda: len(model.chain.vocab))
+registry.gauge('model_bytes', 'Rough memory usage of the chain, excluding the vocabulary', lambda: model.chain.nbytes())
+model_seconds = registry.histogram('model_seconds', 'Time of model updates in the event loop', ['op'])
+lines_ingested = registry.counter('lines_ingested_total', 'Corpus lines stored and fed')
+
+# per-chat chains, tried before the global one
+partitions = ChatPartitions(db,
+    max_chats=config.partition_max_chats if hasattr(config, 'partition_max_chats') else 16,
+    max_lines=config.partition_max_lines if hasattr(config, 'partition_max_lines') else 100000,
+    min_lines=config.partition_min_lines if hasattr(config, 'partition_min_lines') else 1000,
+    idle_seconds=config.partition_idle_seconds if hasattr(config, 'partition_idle_seconds') else 3600,
+    max_bytes=config.partition_max_bytes if hasattr(config, 'partition_max_bytes') else 256 * 2**20)
+
+# sentences generated in the background, for replies not depending on the message
+sentence_pool = SentencePool(workers, model,
+    size=config.pool_size if hasattr(config, 'pool_size') else 32,
+    batch=config.pool_batch if hasattr(config, 'pool_batch') else 8)
 
 get_line_weight = None
 try:
@@ -90,55 +213,76 @@ except AttributeError:
     logging.info('`get_line_weight` not found in config, so weights are set to 1.0')
     get_line_weight = lambda line: 1.0
 
+# write-through caches of user and chat rows, keyed by tgid
+## users missing here are not in the db either
+user_cache = {}
+chat_cache = {}
+# ids of new rows are assigned here, so that callers need not wait for the writer
+next_user_id = 1
+next_chat_id = 1
+
+def load_identities():
+    global next_user_id, next_chat_id
+    cursor.execute("SELECT user_tgid, user_id, user_name, user_right, user_weight FROM user")
+    for user_tgid, user_id, user_name, user_right, user_weight in cursor.fetchall():
+        user_cache[user_tgid] = {'user_id': user_id, 'user_name': user_name,
+                                 'user_right': user_right, 'user_weight': user_weight}
+    cursor.execute("SELECT chat_tgid, chat_id, chat_name FROM chat")
+    for chat_tgid, chat_id, chat_name in cursor.fetchall():
+        chat_cache[chat_tgid] = {'chat_id': chat_id, 'chat_name': chat_name}
+    next_user_id = max((u['user_id'] for u in user_cache.values()), default=0) + 1
+    next_chat_id = max((c['chat_id'] for c in chat_cache.values()), default=0) + 1
+    logging.info(f'Loaded {len(user_cache)} users and {len(chat_cache)} chats')
+
+load_identities()
+
 def add_user(user_tgid, user_name='', user_right=DEFAULT_USER_RIGHT_LEVEL, user_weight=1.):
-    cursor.execute("""
-        INSERT OR IGNORE INTO user (user_tgid, user_name, user_right, user_weight)
-        VALUES (?,?,?,?)
-        """, (user_tgid, user_name, user_right, user_weight))
-    conn.commit()
+    global next_user_id
+    if user_tgid in user_cache:
+        return
+    user_id = next_user_id
+    next_user_id += 1
+    db.execute("""
+        INSERT OR IGNORE INTO user (user_id, user_tgid, user_name, user_right, user_weight)
+        VALUES (?,?,?,?,?)
+        """, (user_id, user_tgid, user_name, user_right, user_weight))
+    user_cache[user_tgid] = {'user_id': user_id, 'user_name': user_name,
+                             'user_right': user_right, 'user_weight': user_weight}
 
 def find_user(user_tgid, user_name='', user_right=DEFAULT_USER_RIGHT_LEVEL, user_weight=1.):
     # return: user_id, will insert if not exist
     add_user(user_tgid, user_name, user_right, user_weight)
-    cursor.execute("SELECT user_id FROM user WHERE user_tgid = ?", (user_tgid,))
-    rst, = cursor.fetchone()
-    return rst
+    return user_cache[user_tgid]['user_id']
 
 def update_user(user_tgid, user_name='', user_right=DEFAULT_USER_RIGHT_LEVEL, user_weight=1.):
     user_id = find_user(user_tgid, user_name, user_right, user_weight)
-    cursor.execute("""
+    db.execute("""
         UPDATE user SET user_name = ?, user_right = ?, user_weight = ?
         WHERE user_id = ?
         """, (user_name, user_right, user_weight, user_id))
-    conn.commit()
+    user_cache[user_tgid].update(user_name=user_name, user_right=user_right, user_weight=user_weight)
 
 def get_user_name(user_tgid):
-    user_id = find_user(user_tgid)
-    cursor.execute("SELECT user_name FROM user WHERE user_id = ?", (user_id,))
-    rst, = cursor.fetchone()
-    return rst or ''
+    user = user_cache.get(user_tgid)
+    return (user and user['user_name']) or ''
 
 def get_user_right(user_tgid):
-    user_id = find_user(user_tgid)
-    cursor.execute("SELECT user_right FROM user WHERE user_id = ?", (user_id,))
-    rst, = cursor.fetchone()
-    return rst or DEFAULT_USER_RIGHT_LEVEL
+    user = user_cache.get(user_tgid)
+    return (user and user['user_right']) or DEFAULT_USER_RIGHT_LEVEL
 
 def set_user_right(user_tgid, new_right):
     user_id = find_user(user_tgid)
-    cursor.execute("UPDATE user SET user_right = ? WHERE user_id = ?", (new_right, user_id))
-    conn.commit()
+    db.execute("UPDATE user SET user_right = ? WHERE user_id = ?", (new_right, user_id))
+    user_cache[user_tgid]['user_right'] = new_right
 
 def get_user_weight(user_tgid):
-    user_id = find_user(user_tgid)
-    cursor.execute("SELECT user_weight FROM user WHERE user_id = ?", (user_id,))
-    rst, = cursor.fetchone()
-    return rst or 1.
+    user = user_cache.get(user_tgid)
+    return (user and user['user_weight']) or 1.
 
 def set_user_weight(user_tgid, new_weight):
     user_id = find_user(user_tgid)
-    cursor.execute("UPDATE user SET user_weight = ? WHERE user_id = ?", (new_weight, user_id))
-    conn.commit()
+    db.execute("UPDATE user SET user_weight = ? WHERE user_id = ?", (new_weight, user_id))
+    user_cache[user_tgid]['user_weight'] = new_weight
 
 def is_banned(user_tgid):
     return get_user_right(user_tgid) <= USER_RIGHT_LEVEL_BANNED
@@ -148,18 +292,21 @@ def chat_is_allowed(chat_id):
     return chat_id > 0 or chat_id in config.chat_ids
 
 def add_chat(chat_tgid, chat_name=''):
-    cursor.execute("""
-        INSERT OR IGNORE INTO chat (chat_tgid, chat_name)
-        VALUES (?,?)
-        """, (chat_tgid, chat_name))
-    conn.commit()
+    global next_chat_id
+    if chat_tgid in chat_cache:
+        return
+    chat_id = next_chat_id
+    next_chat_id += 1
+    db.execute("""
+        INSERT OR IGNORE INTO chat (chat_id, chat_tgid, chat_name)
+        VALUES (?,?,?)
+        """, (chat_id, chat_tgid, chat_name))
+    chat_cache[chat_tgid] = {'chat_id': chat_id, 'chat_name': chat_name}
 
 def find_chat(chat_tgid, chat_name=''):
     # return: chat_id, will insert if not exist
     add_chat(chat_tgid, chat_name)
-    cursor.execute("SELECT chat_id FROM chat WHERE chat_tgid = ?", (chat_tgid,))
-    rst, = cursor.fetchone()
-    return rst
+    return chat_cache[chat_tgid]['chat_id']
 
 LOG_TEMPLATES = {
     'pm': '[{userid}](tg://user?id={userid}) ({username}) sent a pm.',
@@ -169,12 +316,19 @@ LOG_TEMPLATES = {
     'lineweight': '[{userid}](tg://user?id={userid}) ({username}) changed weight of the following line(s) from {weight_old} to {weight_new} in [{chatid}](https://t.me/c/{chatid}/{msgid}).\n{lines}',
     'addword': '[{userid}](tg://user?id={userid}) ({username}) added the following word(s) for {lang} in [{chatid}](https://t.me/c/{chatid}/{msgid}):\n{words}',
     'rmword': '[{userid}](tg://user?id={userid}) ({username}) removed the following word(s) for {lang} in [{chatid}](https://t.me/c/{chatid}/{msgid}):\n{words}',
+    'compact': 'Compacted the chain: {states[0]} → {states[1]} states, {transitions[0]} → {transitions[1]} transitions, {tokens[0]} → {tokens[1]} tokens, {bytes[0]} → {bytes[1]} bytes.',
 }
 
-async def log_in_chat(log_type, fwd_msgs=None, **kwargs):
+# log entries are sent in the background, merged into digests
+chat_log = ChatLog(bot, 0,
+    interval=config.log_interval if hasattr(config, 'log_interval') else 5.,
+    rate=config.log_rate if hasattr(config, 'log_rate') else 0.3)
+
+def log_in_chat(log_type, fwd_msgs=None, **kwargs):
     '''
-    log_type: pm, erase, right, userweight, lineweight, addword
+    log_type: pm, erase, right, userweight, lineweight, addword, rmword, compact
     fwd_msgs: telethon Message(s) object
+    Queued in `chat_log` without waiting.
     '''
     try:
         log_chat_id = config.log_chat_id
@@ -197,16 +351,70 @@ async def log_in_chat(log_type, fwd_msgs=None, **kwargs):
                     f'An error occured when trying to log. See the following kwargs:\n'
                     f'{str(kwargs)}')
 
-    await bot.send_message(log_chat_id, log_text, parse_mode='md')
-    if fwd_msgs:
-        await bot.forward_messages(log_chat_id, fwd_msgs)
+    # log_chat_id can be changed by /reload_config
+    chat_log.chat_id = log_chat_id
+    chat_log.log(log_text, fwd_msgs)
+
+# routing table of commands, name without the slash: (handler, required user right, whether only for groups)
+commands = {}
+
+def command(*names, right=None, groups_only=False):
+    '''
+    Register the decorated coroutine as the handler of /`names`, called with the event.
+    Senders with user rights lower than `right` are told so instead,
+    commands `groups_only` are ignored in PMs.
+    '''
+    def decorator(func):
+        for name in names:
+            commands[name] = (func, right, groups_only)
+        return func
+    return decorator
+
+async def respond_right_required(event, right, user_right=None):
+    if user_right is None:
+        user_right = get_user_right(event.sender_id)
+    hint = '\n如果您已成为特定群的群管，可使用 /reload 指令刷新权限。' if right <= USER_RIGHT_LEVEL_ADMIN else ''
+    await event.respond(f'❌ 此操作需要 {USER_RIGHT_LEVEL_NAME[right]} 权限，'
+        f'您的权限是 {USER_RIGHT_LEVEL_NAME[user_right]}。' + hint)
+
+class Context:
+    '''
+    Per-update context passed to command handlers and reply() in place of the event,
+    with other attributes looked up on the event.
+    The replied message is fetched at most once.
+    '''
+    _unset = object()
+
+    def __init__(self, event):
+        self.event = event
+        self._reply_message = self._unset
+
+    def __getattr__(self, name):
+        return getattr(self.event, name)
+
+    async def get_reply_message(self):
+        if self._reply_message is self._unset:
+            self._reply_message = await self.event.message.get_reply_message() \
+                if self.event.message.reply_to_msg_id else None
+        return self._reply_message
+
+    async def is_reply_to_me(self):
+        # answered from `own_messages` if possible, without fetching the replied message
+        reply_to_msg_id = self.event.message.reply_to_msg_id
+        if not reply_to_msg_id:
+            return False
+        own = own_messages.is_own(self.event.chat_id, reply_to_msg_id)
+        if own is None:
+            reply_to_msg = await self.get_reply_message()
+            own = bool(reply_to_msg and reply_to_msg.out)
+        return own
 
 async def parse(event, cmd='', use_reply=False):
     # parse the command from messages
     text = ''
     if use_reply and event.message.reply_to_msg_id:
         # Use the replied message first
-        reply_to_msg = await event.message.get_reply_message()
+        reply_to_msg = await event.get_reply_message()
         # For stickers: use the emoji
         if reply_to_msg.sticker:
             try:
@@ -234,67 +442,81 @@ async def parse(event, cmd='', use_reply=False):
 
     return text
 
+def store_lines(cursor, text, lines, weights, time, chat, user, raw_id=''):
+    # runs in the db writer, which sees lines stored by earlier messages even if not committed yet
+    # return: lines not in corpus before, and their weights
+    hashes = [content_hash(line) for line in lines]
+    maybe_dup = [h for h in hashes if line_filter is None or h in line_filter]
+    dup_hashes = set()
+    if maybe_dup:
+        cursor.execute(f"""
+            SELECT corpus_hash FROM corpus
+            WHERE corpus_hash IN ({','.join('?'*len(maybe_dup))})
+            """, maybe_dup)
+        dup_hashes = set(r[0] for r in cursor.fetchall())
+    # remove duplicate lines
+    dup_lines = []
+    new_lines = {}
+    for line, h, weight in zip(lines, hashes, weights):
+        if h in dup_hashes:
+            dup_lines.append(line)
+        else:
+            new_lines[line] = (h, weight)
+    logging.info(f'dup_lines: {dup_lines}')
+    if not new_lines:
+        return [], []
+    lines = list(new_lines)
+    hashes, weights = zip(*new_lines.values())
+
+    if raw_id == '':
+        # write to raw table, or get the id of the same text
+        ## updating raw_hash to itself makes RETURNING work on conflicts
+        cursor.execute("""
+            INSERT INTO raw (raw_text, raw_hash) VALUES (?,?)
+            ON CONFLICT (raw_hash) DO UPDATE SET raw_hash = excluded.raw_hash
+            RETURNING raw_id
+            """, (text, content_hash(text)))
+        raw_id, = cursor.fetchone()
+    else:
+        # remove existing corpus lines with specific raw_id
+        cursor.execute("DELETE FROM corpus WHERE corpus_raw = ?", (raw_id,))
+
+    # write to corpus table
+    line_count = len(lines)
+    times = (int(time),) * line_count
+    raws = (raw_id,) * line_count
+    chats = (chat,) * line_count
+    users = (user,) * line_count
+    cursor.executemany("""
+        INSERT OR IGNORE INTO corpus (corpus_time, corpus_line, corpus_hash, corpus_raw, corpus_chat, corpus_user, corpus_weight)
+        VALUES (?,?,?,?,?,?,?)
+        """, zip(times, lines, hashes, raws, chats, users, weights))
+    add_to_line_filter(cursor, hashes)
+    return lines, list(weights)
+
 async def ingest_text(text, tokens, chat_id, sender_id, time, raw_id=''):
     lines = model.cut_lines(text, tokens)
+    if not lines:
+        return
 
-    # remove duplicate lines
-    cursor.execute(f"""
-        SELECT corpus_line FROM corpus
-        WHERE corpus_line IN ({','.join('?'*len(lines))})
-        """, lines)
-    rst = cursor.fetchall()
-    dup_lines = tuple(r[0] for r in rst) or ()
-    logging.info(f'dup_lines: {dup_lines}')
-    lines_set = set(lines)
-    lines_set -= set(dup_lines)
-    lines = list(lines_set)
+    user_weight = get_user_weight(sender_id)
+    weights = tuple(user_weight * get_line_weight(line) for line in lines)
+    chat, user = find_chat(chat_id), find_user(sender_id)
+    epoch = partitions.epoch(chat)
+    lines, weights = await db.write(store_lines, text, lines, weights, time, chat, user, raw_id)
 
     if lines:
-        weights = map(get_line_weight, lines)
-        user_weight = get_user_weight(sender_id)
-        weights = tuple(user_weight * w for w in weights)
-
         logging.info(f'feed: {str(lines)}, user: {sender_id}, chat: {chat_id}, weight: {weights}')
-        model.feed(lines, weight=weights)
-
-        if raw_id == '':
-            # write to raw table
-            cursor.execute("INSERT OR IGNORE INTO raw (raw_text) VALUES (?)", (text,))
-            conn.commit()
-            cursor.execute("SELECT raw_id FROM raw WHERE raw_text = ?", (text,))
-            raw_id, = cursor.fetchone()
-        else:
-            # remove existing corpus lines with specific raw_id
-            cursor.execute("DELETE FROM corpus WHERE corpus_raw = ?", (raw_id,))
-            conn.commit()
-
-        # write to corpus table
-        line_count = len(lines)
-        times = (int(time),) * line_count
-        raws = (raw_id,) * line_count
-        chats = (find_chat(chat_id),) * line_count
-        users = (find_user(sender_id),) * line_count
-        cursor.executemany("""
-            INSERT OR IGNORE INTO corpus (corpus_time, corpus_line, corpus_raw, corpus_chat, corpus_user, corpus_weight)
-            VALUES (?,?,?,?,?,?)
-            """, zip(times, lines, raws, chats, users, weights))
-        conn.commit()
-
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/reload_config($|\s|@{escaped_bot_name})'))
+        with model_seconds.time('feed'):
+            model.feed(lines, weight=weights)
+        lines_ingested.inc(amount=len(lines))
+        partitions.feed(chat, lines, weights, epoch)
+        wordclouds.add((user, chat), lines)
+
+@command('reload_config', right=USER_RIGHT_LEVEL_ROOT)
 async def reload_config(event):
     global get_line_weight
 
-    if not chat_is_allowed(event.chat_id) or is_banned(event.sender_id):
-        return
-
-    sender_id = event.sender_id
-
-    user_right = get_user_right(sender_id)
-    if user_right < USER_RIGHT_LEVEL_ROOT:
-        await event.respond(f'❌ 此操作需要 {USER_RIGHT_LEVEL_NAME[USER_RIGHT_LEVEL_ROOT]} 权限，'
-            f'您的权限是 {USER_RIGHT_LEVEL_NAME[user_right]}。')
-        return
-
     reload(config)
     try:
         get_line_weight = config.get_line_weight
@@ -304,11 +526,8 @@ async def reload_config(event):
 
     await event.respond('✅ 已重新载入配置文件。')
 
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/reload($|\s|@{escaped_bot_name})'))
+@command('reload')
 async def reload_right(event):
-    if not chat_is_allowed(event.chat_id) or is_banned(event.sender_id):
-        return
-
     chat_id = event.chat_id
     sender_id = event.sender_id
     logging.info(f'chat_id: {chat_id}, sender_id: {sender_id}')
@@ -317,9 +536,9 @@ async def reload_right(event):
     if not sender:
         return
 
-    cursor.execute("SELECT user_name, user_right, user_weight FROM user WHERE user_tgid = ?", (sender_id,))
-    rst = cursor.fetchone()
-    cur_name, cur_right, cur_weight = rst or ('', DEFAULT_USER_RIGHT_LEVEL, 1.0)
+    user = user_cache.get(sender_id)
+    cur_name, cur_right, cur_weight = (user['user_name'], user['user_right'], user['user_weight']) \
+        if user else ('', DEFAULT_USER_RIGHT_LEVEL, 1.0)
 
     user_name = cur_name
     # we prefer first name + last name, if None we use username
@@ -356,21 +575,12 @@ async def handle_set_right(event, new_right):
     chat_id = event.chat_id
     sender_id = event.sender_id
 
-    # only usable in groups
-    if event.chat_id > 0 or not chat_is_allowed(event.chat_id) or is_banned(event.sender_id):
-        return
-
     user_right = get_user_right(sender_id)
-    if user_right < USER_RIGHT_LEVEL_ADMIN:
-        await event.respond(f'❌ 此操作需要 {USER_RIGHT_LEVEL_NAME[USER_RIGHT_LEVEL_ADMIN]} 权限，'
-            f'您的权限是 {USER_RIGHT_LEVEL_NAME[user_right]}。\n'
-            f'如果您已成为特定群的群管，可使用 /reload 指令刷新权限。')
-        return
 
     target_tgid = 0
     if event.message.reply_to_msg_id:
         # Use the replied user as target first
-        reply_to_msg = await event.message.get_reply_message()
+        reply_to_msg = await event.get_reply_message()
         try:
             target_tgid = reply_to_msg.from_id.user_id
         except:
@@ -387,8 +597,7 @@ async def handle_set_right(event, new_right):
 
     target_right = get_user_right(target_tgid)
     if (new_right == USER_RIGHT_LEVEL_ROOT or target_right == USER_RIGHT_LEVEL_ROOT) and user_right < USER_RIGHT_LEVEL_ROOT:
-        await event.respond(f'❌ 此操作需要 {USER_RIGHT_LEVEL_NAME[USER_RIGHT_LEVEL_ROOT]} 权限，'
-            f'您的权限是 {USER_RIGHT_LEVEL_NAME[user_right]}。')
+        await respond_right_required(event, USER_RIGHT_LEVEL_ROOT, user_right)
         return
     if new_right == target_right:
         await event.respond('目标用户已经是该权限，无事发生。')
@@ -400,52 +609,43 @@ async def handle_set_right(event, new_right):
     set_user_right(target_tgid, new_right)
     user_name = get_user_name(sender_id) or sender_id
     target_name = get_user_name(target_tgid) or target_tgid
-    await log_in_chat('right', fwd_msgs=event.message, username=user_name, userid=sender_id,
+    log_in_chat('right', fwd_msgs=event.message, username=user_name, userid=sender_id,
         targetname=target_name, targetid=target_tgid, right_old=target_right, right_new=new_right,
         chatid=chat_id, msgid=event.message.id)
     await event.respond(f'✅ [{target_tgid}](tg://user?id={target_tgid}) 的权限已从 {USER_RIGHT_LEVEL_NAME[target_right]} 变更为 {USER_RIGHT_LEVEL_NAME[new_right]}。')
 
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/ban($|\s|@{escaped_bot_name})'))
+@command('ban', right=USER_RIGHT_LEVEL_ADMIN, groups_only=True)
 async def ban(event):
     await handle_set_right(event, USER_RIGHT_LEVEL_BANNED)
 
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/restrict($|\s|@{escaped_bot_name})'))
+@command('restrict', right=USER_RIGHT_LEVEL_ADMIN, groups_only=True)
 async def restrict(event):
     await handle_set_right(event, USER_RIGHT_LEVEL_RESTRICTED)
 
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/grantnormal($|\s|@{escaped_bot_name})'))
+@command('grantnormal', right=USER_RIGHT_LEVEL_ADMIN, groups_only=True)
 async def grantnormal(event):
     await handle_set_right(event, USER_RIGHT_LEVEL_NORMAL)
 
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/granttrusted($|\s|@{escaped_bot_name})'))
+@command('granttrusted', right=USER_RIGHT_LEVEL_ADMIN, groups_only=True)
 async def granttrusted(event):
     await handle_set_right(event, USER_RIGHT_LEVEL_TRUSTED)
 
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/grantadmin($|\s|@{escaped_bot_name})'))
+@command('grantadmin', right=USER_RIGHT_LEVEL_ADMIN, groups_only=True)
 async def grantadmin(event):
     await handle_set_right(event, USER_RIGHT_LEVEL_ADMIN)
 
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/userweight($|\s|@{escaped_bot_name})'))
+@command('userweight', right=USER_RIGHT_LEVEL_ADMIN, groups_only=True)
 async def userweight(event):
     chat_id = event.chat_id
     sender_id = event.sender_id
 
-    # only usable in groups
-    if event.chat_id > 0 or not chat_is_allowed(event.chat_id) or is_banned(event.sender_id):
-        return
-
     user_right = get_user_right(sender_id)
-    if user_right < USER_RIGHT_LEVEL_ADMIN:
-        await event.respond(f'❌ 此操作需要 {USER_RIGHT_LEVEL_NAME[USER_RIGHT_LEVEL_ADMIN]} 权限，'
-            f'您的权限是 {USER_RIGHT_LEVEL_NAME[user_right]}。\n'
-            f'如果您已成为特定群的群管，可使用 /reload 指令刷新权限。')
-        return
 
     target_tgid, new_weight = 0, None
     text = await parse(event, cmd='/userweight')
     if event.message.reply_to_msg_id:
         # Use the replied user as target first
-        reply_to_msg = await event.message.get_reply_message()
+        reply_to_msg = await event.get_reply_message()
         try:
             target_tgid = reply_to_msg.from_id.user_id
             new_weight = float(text)
@@ -464,8 +664,7 @@ async def userweight(event):
 
     target_right = get_user_right(target_tgid)
     if target_right == USER_RIGHT_LEVEL_ROOT and user_right < USER_RIGHT_LEVEL_ROOT:
-        await event.respond(f'❌ 此操作需要 {USER_RIGHT_LEVEL_NAME[USER_RIGHT_LEVEL_ROOT]} 权限，'
-            f'您的权限是 {USER_RIGHT_LEVEL_NAME[user_right]}。')
+        await respond_right_required(event, USER_RIGHT_LEVEL_ROOT, user_right)
         return
 
     if target_right == USER_RIGHT_LEVEL_ADMIN:
@@ -479,28 +678,22 @@ async def userweight(event):
     set_user_weight(target_tgid, new_weight)
     user_name = get_user_name(sender_id) or sender_id
     target_name = get_user_name(target_tgid) or target_tgid
-    await log_in_chat('userweight', fwd_msgs=event.message, username=user_name, userid=sender_id,
+    log_in_chat('userweight', fwd_msgs=event.message, username=user_name, userid=sender_id,
         targetname=target_name, targetid=target_tgid, weight_old=cur_weight, weight_new=new_weight,
         chatid=chat_id, msgid=event.message.id)
     await event.respond(f'✅ [{target_tgid}](tg://user?id={target_tgid}) 的权重已从 {cur_weight} 变更为 {new_weight}。\n'
         '请注意：过去由该用户输入的语料权重将**不会**改变。如有特别需要，请联系操作者。')
 
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/start($|\s|@{escaped_bot_name})'))
+@command('start')
 async def start(event):
-    if not chat_is_allowed(event.chat_id) or is_banned(event.sender_id):
-        return
-
     # require mentioning bot name in groups
     if event.chat_id < 0 and not (event.message.message or event.raw_text).startswith(f'/start@{bot_name}'):
         return
 
     await event.respond('我通过了你的好友验证请求，现在我们可以开始聊天了。')
 
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/policy($|\s|@{escaped_bot_name})'))
+@command('policy')
 async def policy(event):
-    if not chat_is_allowed(event.chat_id) or is_banned(event.sender_id):
-        return
-
     await event.respond('我只收集群聊中回复给我的文字消息，也接受私聊，'
         f'但 {USER_RIGHT_LEVEL_NAME[USER_RIGHT_LEVEL_TRUSTED]} 及以上权限者的私聊文字才会被记录。\n'
         '由于各群目前共享语料库，为防止滥用，我不接受邀请加入群组。如有需要，请发送 /source 指令查看源代码并自行架设机器人。\n'
@@ -508,18 +701,12 @@ async def policy(event):
         f'如需从语料库中删除句子，请联系 {USER_RIGHT_LEVEL_NAME[USER_RIGHT_LEVEL_ADMIN]} 及以上权限的用户。\n'
         '本机器人仅供测试用途，不保证今后功能不会变化。本原则的内容若发生变化亦恕不另行通知。')
 
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/source($|\s|@{escaped_bot_name})'))
+@command('source')
 async def source(event):
-    if not chat_is_allowed(event.chat_id) or is_banned(event.sender_id):
-        return
-
     await event.respond('My [source code](https://github.com/fossifer/hanasubot) is on Github. Stars are highly appreciated <3', parse_mode='md')
 
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/clddbg($|\s|@{escaped_bot_name})'))
+@command('clddbg')
 async def clddbg(event):
-    if not chat_is_allowed(event.chat_id) or is_banned(event.sender_id):
-        return
-
     text = await parse(event, cmd='/clddbg', use_reply=True)
     response = ''
 
@@ -529,28 +716,107 @@ async def clddbg(event):
     if response:
         await event.respond(response)
 
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/cutdbg($|\s|@{escaped_bot_name})'))
+@command('cutdbg')
 async def cutdbg(event):
-    if not chat_is_allowed(event.chat_id) or is_banned(event.sender_id):
-        return
-
     text = await parse(event, cmd='/cutdbg', use_reply=True)
     response = ''
 
     if text:
-        response = ' '.join(model.cut(text))
+        response = ' '.join(await workers.cut(text))
 
     if response:
         await event.respond(response)
 
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/addword($|\s|@{escaped_bot_name})'))
+retokenize_lock = asyncio.Lock()
+retokenize_batch_size = config.retokenize_batch_size if hasattr(config, 'retokenize_batch_size') else 1000
+retokenize_confirm_lines = config.retokenize_confirm_lines if hasattr(config, 'retokenize_confirm_lines') else 20000
+
+def update_lines(cursor, updates):
+    # runs in the db writer
+    # updates: (corpus_line, corpus_hash, corpus_id)
+    cursor.executemany("UPDATE OR IGNORE corpus SET corpus_line = ?, corpus_hash = ? WHERE corpus_id = ?", updates)
+    add_to_line_filter(cursor, [u[1] for u in updates])
+
+async def retokenize(event, msg, text, user_right, added):
+    '''
+    Re-tokenize corpus lines affected by adding (or removing) `text` in user dictionaries.
+    Lines are found with the full-text indexes and tokenized by workers in batches,
+    then written back with a single executemany and applied to the model as a single delta.
+    Progress is shown by editing `msg`.
+    '''
+    searchstr = '%'+text+'%'
+    if len(text) >= 3:
+        candidates = """
+            corpus_id IN (SELECT rowid FROM corpus_fts WHERE corpus_text LIKE ?)
+            AND corpus_raw IN (SELECT rowid FROM raw_fts WHERE raw_text LIKE ?)"""
+    else:
+        # trigram indexes find nothing for patterns shorter than 3 characters, scan instead
+        candidates = """
+            REPLACE(corpus_line, ' ', '') LIKE ?
+            AND corpus_raw IN (SELECT raw_id FROM raw WHERE raw_text LIKE ?)"""
+    # one job at a time, so that jobs don't re-tokenize the same lines concurrently
+    async with retokenize_lock:
+        if added:
+            # find relative lines, which should not contain `text` (or we don't need to tokenize it again)
+            ## but after removing whitespaces it should contain `text`
+            cursor.execute(f"""
+                SELECT corpus_id, corpus_line, corpus_weight FROM corpus
+                WHERE {candidates}
+                AND corpus_line NOT LIKE ?
+                """, (searchstr, searchstr, searchstr))
+        else:
+            # find relative lines, which should contain `text` apparently
+            cursor.execute(f"""
+                SELECT corpus_id, corpus_line, corpus_weight FROM corpus
+                WHERE {candidates}
+                AND corpus_line LIKE ?
+                """, (searchstr, searchstr, searchstr))
+        rst = cursor.fetchall()
+        if not rst:
+            await event.respond(f'✅ 没有找到需要包含 {text} 的语料，无需重新分词。')
+            return
+        [ids, lines, weights] = zip(*rst)
+        if len(ids) > retokenize_confirm_lines and user_right < USER_RIGHT_LEVEL_ROOT:
+            await event.respond(f'❌ 包含 {text} 的语料超过 {retokenize_confirm_lines} 条 ({len(ids)})，需要 {USER_RIGHT_LEVEL_NAME[USER_RIGHT_LEVEL_ROOT]} 权限者确认重新分词。')
+            return
+
+        new_tokens = []
+        last_report = time.monotonic()
+        for start in range(0, len(lines), retokenize_batch_size):
+            batch = lines[start:start+retokenize_batch_size]
+            new_tokens += await workers.cut_many((line.replace(' ', '') for line in batch),
+                timeout=workers.timeout + 0.05 * len(batch))
+            if time.monotonic() - last_report > 3 and len(new_tokens) < len(lines):
+                last_report = time.monotonic()
+                try:
+                    await msg.edit(f'{msg.message}\n🕙 {len(new_tokens)}/{len(lines)}')
+                except Exception as e:
+                    logging.info(f'retokenize: failed to report progress: {e}')
+
+        updates = []
+        lines_to_erase = []
+        lines_to_feed = []
+        changed_weights = []
+        for cur_id, cur_line, cur_weight, tokens in zip(ids, lines, weights, new_tokens):
+            new_line = ' '.join(tokens)
+            if new_line != cur_line:
+                updates.append((new_line, content_hash(new_line), cur_id))
+                lines_to_erase.append(cur_line)
+                lines_to_feed.append(new_line)
+                changed_weights.append(cur_weight)
+        db.submit(update_lines, updates)
+        model.feed(lines_to_erase + lines_to_feed,
+            weight=[-1 * w for w in changed_weights] + changed_weights)
+        wordclouds.clear()
+        partitions.clear()
+        sentence_pool.clear()
+    await event.respond(f'✅ 已完成重新分词 {len(lines_to_feed)} 条包含 {text} 的语料。')
+
+@command('addword', 'addword_cn', 'addword_tw', right=USER_RIGHT_LEVEL_TRUSTED)
 async def addword(event):
     chat_id = event.chat_id
     sender_id = event.sender_id
 
-    if not chat_is_allowed(chat_id) or is_banned(sender_id):
-        return
-
     text = await parse(event)
     is_cn, is_tw = True, True
     if text.startswith('/addword_cn'):
@@ -559,11 +825,6 @@ async def addword(event):
         is_cn = False
 
     user_right = get_user_right(sender_id)
-    if user_right < USER_RIGHT_LEVEL_TRUSTED:
-        await event.respond(f'❌ 此操作需要 {USER_RIGHT_LEVEL_NAME[USER_RIGHT_LEVEL_TRUSTED]} 权限，'
-            f'您的权限是 {USER_RIGHT_LEVEL_NAME[user_right]}。\n'
-            f'如果您已成为特定群的群管，可使用 /reload 指令刷新权限。')
-        return
 
     try:
         text = text.split(' ', 1)[1]
@@ -574,11 +835,11 @@ async def addword(event):
         await event.respond('❌ 添加失败，每次只允许加入一个词。')
         return
 
-    await event.respond('🕙 正在写入外部文件并重新加载模型，请稍等。')
+    await event.respond('🕙 正在更新字典，请稍等。')
 
     # add word into model
     if is_cn and not model.addword_cn(text):
-        await event.respond('❌ 简体字典添加失败，该词已存在，或未找到词典文件。')
+        await event.respond('❌ 简体字典添加失败，该词已存在。')
         is_cn = False
     if is_tw and not model.addword_tw(text):
         await event.respond('❌ 繁体字典添加失败，该词已存在。')
@@ -588,61 +849,21 @@ async def addword(event):
 
     user_name = get_user_name(sender_id) or sender_id
     if is_cn:
-        await log_in_chat('addword', fwd_msgs=event.message, username=user_name, userid=sender_id,
+        log_in_chat('addword', fwd_msgs=event.message, username=user_name, userid=sender_id,
             lang='zh-hans', chatid=chat_id, msgid=event.message.id, words=text)
     if is_tw:
-        await log_in_chat('addword', fwd_msgs=event.message, username=user_name, userid=sender_id,
+        log_in_chat('addword', fwd_msgs=event.message, username=user_name, userid=sender_id,
             lang='zh-hant', chatid=chat_id, msgid=event.message.id, words=text)
 
     # re-tokenize in db and in memory
     msg = await event.respond('✅ 添加成功，将对语料库进行重新分词，可能需要一些时间，完成后将再次发送消息。')
-    searchstr = '%'+text+'%'
-    cursor.execute("SELECT raw_id FROM raw WHERE raw_text LIKE ?", (searchstr,))
-    rst = cursor.fetchall()
-    raw_ids = tuple(r[0] for r in rst) or ()
-    if not raw_ids:
-        await event.respond(f'✅ 没有找到需要包含 {text} 的语料，无需重新分词。')
-        return
-    # find relative lines, which should not contain `text` (or we don't need to tokenize it again)
-    ## but after removing whitespaces it should contain `text`
-    cursor.execute(f"""
-        SELECT corpus_id, corpus_line, corpus_weight FROM corpus
-        WHERE corpus_raw IN ({','.join('?'*len(raw_ids))})
-        AND corpus_line NOT LIKE ?
-        AND REPLACE(corpus_line, ' ', '') LIKE ?
-        """, raw_ids + (searchstr, searchstr))
-    rst = cursor.fetchall()
-    if not rst:
-        await event.respond(f'✅ 没有找到需要包含 {text} 的语料，无需重新分词。')
-        return
-    [ids, lines, weights] = zip(*rst)
-    if len(ids) > 1000 and user_right < USER_RIGHT_LEVEL_ROOT:
-        await event.respond(f'❌ 包含 {text} 的语料超过 1000 条 ({len(ids)})，需要 {USER_RIGHT_LEVEL_NAME[USER_RIGHT_LEVEL_ROOT]} 权限者确认重新分词。')
-        return
-    lines_to_erase = []
-    lines_to_feed = []
-    weights_to_erase = []
-    for cur_id, cur_line, cur_weight in zip(ids, lines, weights):
-        new_line = ' '.join(model.cut(cur_line.replace(' ', '')))
-        if new_line != cur_line:
-            cursor.execute("UPDATE OR IGNORE corpus SET corpus_line = ? WHERE corpus_id = ?", (new_line, cur_id))
-            lines_to_erase.append(cur_line)
-            lines_to_feed.append(new_line)
-            weights_to_erase.append(-1 * cur_weight)
-    conn.commit()
-    model.erase(lines_to_erase, weight=weights_to_erase)
-    model.feed(lines_to_feed, weight=[-1*w for w in weights_to_erase])
-    await event.respond(f'✅ 已完成重新分词 {len(lines_to_feed)} 条包含 {text} 的语料。')
+    await retokenize(event, msg, text, user_right, added=True)
 
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/rmword($|\s|@{escaped_bot_name})'))
+@command('rmword', 'rmword_cn', 'rmword_tw', right=USER_RIGHT_LEVEL_TRUSTED)
 async def rmword(event):
     chat_id = event.chat_id
     sender_id = event.sender_id
 
-    if not chat_is_allowed(chat_id) or is_banned(sender_id):
-        return
-
-    text = await parse(event)
     text = await parse(event)
     is_cn, is_tw = True, True
     if text.startswith('/rmword_cn'):
@@ -651,11 +872,6 @@ async def rmword(event):
         is_cn = False
 
     user_right = get_user_right(sender_id)
-    if user_right < USER_RIGHT_LEVEL_TRUSTED:
-        await event.respond(f'❌ 此操作需要 {USER_RIGHT_LEVEL_NAME[USER_RIGHT_LEVEL_TRUSTED]} 权限，'
-            f'您的权限是 {USER_RIGHT_LEVEL_NAME[user_right]}。\n'
-            f'如果您已成为特定群的群管，可使用 /reload 指令刷新权限。')
-        return
 
     try:
         text = text.split(' ', 1)[1]
@@ -666,11 +882,11 @@ async def rmword(event):
         await event.respond('❌ 添加失败，每次只允许删除一个词。')
         return
 
-    await event.respond('🕙 正在写入外部文件并重新加载模型，请稍等。')
+    await event.respond('🕙 正在更新字典，请稍等。')
 
     # remove word from model
     if is_cn and not model.rmword_cn(text):
-        await event.respond('❌ 简体字典删除失败，该词不存在，或未找到词典文件。')
+        await event.respond('❌ 简体字典删除失败，该词不存在。')
         is_cn = False
     if is_tw and not model.rmword_tw(text):
         await event.respond('❌ 繁体字典删除失败，该词不存在。')
@@ -680,135 +896,216 @@ async def rmword(event):
 
     user_name = get_user_name(sender_id) or sender_id
     if is_cn:
-        await log_in_chat('rmword', fwd_msgs=event.message, username=user_name, userid=sender_id,
+        log_in_chat('rmword', fwd_msgs=event.message, username=user_name, userid=sender_id,
             lang='zh-hans', chatid=chat_id, msgid=event.message.id, words=text)
     if is_tw:
-        await log_in_chat('rmword', fwd_msgs=event.message, username=user_name, userid=sender_id,
+        log_in_chat('rmword', fwd_msgs=event.message, username=user_name, userid=sender_id,
             lang='zh-hant', chatid=chat_id, msgid=event.message.id, words=text)
 
     # re-tokenize in db and in memory
     msg = await event.respond('✅ 删除成功，将对语料库进行重新分词，可能需要一些时间，完成后将再次发送消息。')
-    searchstr = '%'+text+'%'
-    cursor.execute("SELECT raw_id FROM raw WHERE raw_text LIKE ?", (searchstr,))
-    rst = cursor.fetchall()
-    raw_ids = tuple(r[0] for r in rst) or ()
-    if not raw_ids:
-        await event.respond(f'✅ 没有找到需要包含 {text} 的语料，无需重新分词。')
+    await retokenize(event, msg, text, user_right, added=False)
+
+stopwords = set(line.strip() for line in open(config.STOPWORD_PATH)) if hasattr(config, 'STOPWORD_PATH') else set()
+def render_wordcloud(frequencies):
+    # return: png image
+    wordcloud = WordCloud(font_path=config.FONT_PATH, width=1024, height=768).generate_from_frequencies(frequencies)
+    image = BytesIO()
+    wordcloud.to_image().save(image, format='png', optimize=True)
+    return image.getvalue()
+
+wordclouds = WordClouds(workers, render_wordcloud, stopwords,
+    max_images=config.wordcloud_cache_size if hasattr(config, 'wordcloud_cache_size') else 32)
+
+def wordcloud_file(image):
+    # telethon needs a file name to send bytes as a photo
+    f = BytesIO(image)
+    f.name = 'wordcloud.png'
+    return f
+
+def load_wordcloud(key):
+    if wordclouds.loaded(key):
         return
-    # find relative lines, which should contain `text` apparently
     cursor.execute(f"""
-        SELECT corpus_id, corpus_line, corpus_weight FROM corpus
-        WHERE corpus_raw IN ({','.join('?'*len(raw_ids))})
-        AND corpus_line LIKE ?
-        """, raw_ids + (searchstr,))
-    rst = cursor.fetchall()
-    if not rst:
-        await event.respond(f'✅ 没有找到需要包含 {text} 的语料，无需重新分词。')
-        return
-    [ids, lines, weights] = zip(*rst)
-    if len(ids) > 1000 and user_right < USER_RIGHT_LEVEL_ROOT:
-        await event.respond(f'❌ 包含 {text} 的语料超过 1000 条 ({len(ids)})，需要 {USER_RIGHT_LEVEL_NAME[USER_RIGHT_LEVEL_ROOT]} 权限者确认重新分词。')
-        return
-    lines_to_erase = []
-    lines_to_feed = []
-    weights_to_erase = []
-    for cur_id, cur_line, cur_weight in zip(ids, lines, weights):
-        new_line = ' '.join(model.cut(cur_line.replace(' ', '')))
-        if new_line != cur_line:
-            cursor.execute("UPDATE OR IGNORE corpus SET corpus_line = ? WHERE corpus_id = ?", (new_line, cur_id))
-            lines_to_erase.append(cur_line)
-            lines_to_feed.append(new_line)
-            weights_to_erase.append(-1 * cur_weight)
-    conn.commit()
-    model.erase(lines_to_erase, weight=weights_to_erase)
-    model.feed(lines_to_feed, weight=[-1*w for w in weights_to_erase])
-    await event.respond(f'✅ 已完成重新分词 {len(lines_to_feed)} 条包含 {text} 的语料。')
+        SELECT corpus_line FROM corpus
+        WHERE corpus_user = ?
+        AND corpus_chat = ?
+        ORDER BY corpus_time DESC
+        LIMIT ?;
+    """, (*key, wordclouds.window))
+    wordclouds.load(key, [r[0] for r in reversed(cursor.fetchall())])
 
-stopwords = set(line.strip() for line in open(config.STOPWORD_PATH)) if hasattr(config, 'STOPWORD_PATH') else set()
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/wordcloud($|\s|@{escaped_bot_name})'))
-async def erase(event):
-    # TODO: parse()
+@command('wordcloud')
+async def wordcloud(event):
     chat_id = event.chat_id
     sender_id = event.sender_id
 
-    if not chat_is_allowed(chat_id) or is_banned(sender_id):
-        return
-
     user_id = find_user(sender_id)
     if not user_id: 
         await event.reply('我还不认识你。')
+        return
 
-    cursor.execute(f"""
-        SELECT corpus_line FROM corpus
-        WHERE corpus_user = ?
-        AND corpus_chat = ?
-        ORDER BY corpus_time DESC
-        LIMIT 500;
-    """, (user_id, find_chat(chat_id)))
-    rst = cursor.fetchall()
-    if not rst:
+    key = (user_id, find_chat(chat_id))
+    load_wordcloud(key)
+    line_count = wordclouds.line_count(key)
+    caption = f'请查收您近期 {line_count} 条消息组成的词云。其中只包括{"本群" if chat_id < 0 else "该私聊中"}我收集的，即您回复给我的消息。'
+
+    image = wordclouds.cached_image(key)
+    if image:
+        await event.reply(caption, file=wordcloud_file(image))
+        return
+    if not line_count:
         await event.reply('您水量不够多，无法生成词云。')
         return
     msg = await event.reply('🕙 正在生成词云，请稍等……', file=config.PLACEHOLDER_PATH)
-    lines = tuple(r[0] for r in rst)
-    text = '\n'.join(lines)
-
-    tmpfile = tempfile.NamedTemporaryFile(suffix='.png')
-    wordcloud = WordCloud(font_path=config.FONT_PATH, stopwords=stopwords, width=1024, height=768).generate(text)
-    wordcloud.to_file(tmpfile.name)
-    #await bot.send_file(chat_id, tmpfile.name, reply_to=event.id, caption=f'请查收您近期 {len(lines)} 条消息组成的词云。其中只包括{"本群" if chat_id < 0 else "该私聊中"}我收集的，即您回复给我的消息。')
-    await msg.edit(f'请查收您近期 {len(lines)} 条消息组成的词云。其中只包括{"本群" if chat_id < 0 else "该私聊中"}我收集的，即您回复给我的消息。', file=tmpfile.name)
-    tmpfile.close()
+    # cleared meanwhile by erasing
+    load_wordcloud(key)
+    image = await wordclouds.image(key)
+    if not image:
+        await msg.edit('您水量不够多，无法生成词云。', file=None)
+        return
+    await msg.edit(caption, file=wordcloud_file(image))
+
+reprocess_lock = asyncio.Lock()
+reprocess_batch_size = config.reprocess_batch_size if hasattr(config, 'reprocess_batch_size') else 1000
+
+def get_reprocess_progress(cursor, restart=False):
+    # runs in the db writer
+    # return: raw_id of the last processed raw text, 0 if not started
+    cursor.execute("CREATE TABLE IF NOT EXISTS reprocess_progress(progress_raw integer)")
+    if restart:
+        cursor.execute("DELETE FROM reprocess_progress")
+    cursor.execute("SELECT progress_raw FROM reprocess_progress")
+    rst = cursor.fetchone()
+    return rst[0] if rst else 0
 
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/reprocessraw($|\s|@{escaped_bot_name})'))
+def replace_raw_lines(cursor, raw_ids, corpus_rows, last_raw):
+    # runs in the db writer
+    # corpus_rows: (corpus_time, corpus_line, corpus_hash, corpus_raw, corpus_chat, corpus_user, corpus_weight)
+    cursor.execute(f"""
+        DELETE FROM corpus
+        WHERE corpus_raw IN ({','.join('?'*len(raw_ids))})
+        """, raw_ids)
+    cursor.executemany("""
+        INSERT OR IGNORE INTO corpus (corpus_time, corpus_line, corpus_hash, corpus_raw, corpus_chat, corpus_user, corpus_weight)
+        VALUES (?,?,?,?,?,?,?)
+        """, corpus_rows)
+    add_to_line_filter(cursor, [r[2] for r in corpus_rows])
+    # checkpoint, committed with the lines
+    cursor.execute("DELETE FROM reprocess_progress")
+    cursor.execute("INSERT INTO reprocess_progress (progress_raw) VALUES (?)", (last_raw,))
+
+def commit_watermark(cursor):
+    # runs in the db writer
+    # return: max corpus_id, after committing rows up to it
+    cursor.connection.commit()
+    cursor.execute("SELECT IFNULL(MAX(corpus_id), 0) FROM corpus")
+    return cursor.fetchone()[0]
+
+def lines_after(cursor, watermark):
+    # runs in the db writer, so that lines not committed yet are included
+    cursor.execute("SELECT corpus_line, corpus_weight FROM corpus WHERE corpus_id > ? ORDER BY corpus_id", (watermark,))
+    return cursor.fetchall()
+
+async def reprocess(event, restart=False):
+    '''
+    Re-tokenize raw texts, and replace their corpus lines, in batches of raw_id order.
+    The last processed raw_id is saved with each batch, so an interrupted job resumes from there.
+    The chain is rebuilt once at the end, the bot keeps serving with the old one until then.
+    '''
+    last_raw = await db.write(get_reprocess_progress, restart)
+    cursor.execute("SELECT COUNT(*) FROM raw WHERE raw_id > ?", (last_raw,))
+    total, = cursor.fetchone()
+    status = f'🕙 正在重新处理 {total} 条原始消息' + ('（从上次中断处继续）' if last_raw else '') + '，完成后将再次发送消息。'
+    msg = await event.respond(status)
+    user_weights = {u['user_id']: u['user_weight'] or 1. for u in user_cache.values()}
+
+    done = 0
+    last_report = time.monotonic()
+    while True:
+        cursor.execute("SELECT raw_id, raw_text FROM raw WHERE raw_id > ? ORDER BY raw_id LIMIT ?",
+            (last_raw, reprocess_batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        raw_ids = [r[0] for r in rows]
+        # lines keep the time, chat and user of the lines they replace
+        ## raw texts whose lines are all erased are skipped
+        cursor.execute(f"""
+            SELECT corpus_raw, MIN(corpus_id), corpus_time, corpus_chat, corpus_user FROM corpus
+            WHERE corpus_raw IN ({','.join('?'*len(raw_ids))})
+            GROUP BY corpus_raw
+            """, raw_ids)
+        sources = {r[0]: r[2:] for r in cursor.fetchall()}
+        rows = [r for r in rows if r[0] in sources]
+
+        # split the batch, so that it's tokenized by all worker processes
+        chunks = [[r[1] for r in rows[i:i+100]] for i in range(0, len(rows), 100)]
+        results = await asyncio.gather(*(workers.cut_many(chunk, timeout=workers.timeout + 0.05 * len(chunk))
+            for chunk in chunks))
+        corpus_rows = []
+        for (raw_id, raw_text), tokens in zip(rows, (t for result in results for t in result)):
+            corpus_time, chat, user = sources[raw_id]
+            for line in (model.cut_lines(raw_text, tokens) if tokens else []):
+                weight = user_weights.get(user, 1.) * get_line_weight(line)
+                corpus_rows.append((corpus_time, line, content_hash(line), raw_id, chat, user, weight))
+        last_raw = raw_ids[-1]
+        await db.write(replace_raw_lines, [r[0] for r in rows], corpus_rows, last_raw)
+
+        done += len(raw_ids)
+        if time.monotonic() - last_report > 5:
+            last_report = time.monotonic()
+            try:
+                await msg.edit(f'{status}\n🕙 {done}/{total}')
+            except Exception as e:
+                logging.info(f'reprocess: failed to report progress: {e}')
+
+    await msg.edit(f'{status}\n🕙 正在重建模型……')
+    watermark = await db.write(commit_watermark)
+    loop = asyncio.get_event_loop()
+    chain = await loop.run_in_executor(None, model.rebuild_from_db, config.dbfile, watermark)
+    # lines stored while rebuilding
+    rst = await db.write(lines_after, watermark)
+    model.replace_chain(chain, *zip(*rst))
+    wordclouds.clear()
+    partitions.clear()
+    sentence_pool.clear()
+    await db.write(get_reprocess_progress, True)
+    await event.respond(f'✅ 已重新处理 {done} 条原始消息，并重新载入模型。')
+
+@command('reprocessraw', right=USER_RIGHT_LEVEL_ROOT)
 async def reprocessraw(event):
-    chat_id = event.chat_id
-    sender_id = event.sender_id
-
-    if not chat_is_allowed(chat_id) or is_banned(sender_id):
+    if reprocess_lock.locked():
+        await event.respond('❌ 重新处理正在进行中。')
         return
-    
-    user_right = get_user_right(sender_id)
-    if user_right < USER_RIGHT_LEVEL_ROOT:
-        await event.respond(f'❌ 此操作需要 {USER_RIGHT_LEVEL_NAME[USER_RIGHT_LEVEL_ROOT]} 权限，'
-            f'您的权限是 {USER_RIGHT_LEVEL_NAME[user_right]}。\n'
-            f'如果您已成为特定群的群管，可使用 /reload 指令刷新权限。')
-        return
-
-    cursor.execute("SELECT raw_id, raw_text, raw_chat, raw_user FROM raw")
-    rows = cursor.fetchall()
-    for row in rows:
-        raw_id, raw_text, raw_chat, raw_user = row
-        tokens = model.cut(raw_text)
-        await ingest_text(raw_text, tokens, raw_chat, raw_user, mktime(event.message.date.timetuple()), raw_id)
-    
-    await event.respond('✅重新處理完成，請重新啟動bot來載入新模型。')
-    
-    
-@bot.on(events.NewMessage(incoming=True))
+    # `/reprocessraw restart` ignores the progress of an interrupted job
+    text = await parse(event, cmd='/reprocessraw')
+    async with reprocess_lock:
+        await reprocess(event, restart=(text.strip() == 'restart'))
+
+def pooled_response(chain, tokens):
+    # a pooled sentence containing a keyword of the message, the rarest first like CorpusModel.respond()
+    words = [tok for tok in tokens if tok not in FULL_PUNCT_LIST]
+    for keyword in model.keyword_candidates(words, chain)[:model.max_keywords]:
+        sentence = sentence_pool.get(chain, keyword)
+        if sentence:
+            return sentence
+    return None
+
 async def reply(event):
     chat_id = event.chat_id
     sender_id = event.sender_id
 
-    if not chat_is_allowed(chat_id) or is_banned(sender_id):
-        return
-
     text = await parse(event)
     response = ''
 
-    # we handle our commands in other functions
-    for cmd in COMMAND_LIST:
-        if text.startswith(cmd):
-            return
-
     # only say something when we are replied in groups
     if chat_id < 0:
         if event.forward:
             return
         should_always_respond = config.always_respond_to.get(sender_id)
         if event.is_reply:
-            reply_to_msg = await event.message.get_reply_message()
-            if (not should_always_respond) and (not reply_to_msg.sender.is_self):
+            if (not should_always_respond) and (not await event.is_reply_to_me()):
                 return
         else:
             if not should_always_respond:
@@ -816,32 +1113,70 @@ async def reply(event):
     else:
         should_always_respond = False
         user_name = get_user_name(sender_id) or sender_id
-        await log_in_chat('pm', fwd_msgs=event.message, username=user_name, userid=sender_id)
+        log_in_chat('pm', fwd_msgs=event.message, username=user_name, userid=sender_id)
 
-    if text:
-        tokens = model.cut(text)
-        response = model.respond(text, tokens=tokens) or model.generate()
-        if get_user_right(sender_id) >= (USER_RIGHT_LEVEL_NORMAL if chat_id < 0 else USER_RIGHT_LEVEL_TRUSTED):
-            await ingest_text(text, tokens, chat_id, sender_id, mktime(event.message.date.timetuple()))
-    else:
-        response = model.generate()
+    # generation stops at the length limit or the deadline, instead of truncating afterwards
+    max_chars = config.MAX_MSG_LEN if hasattr(config, 'MAX_MSG_LEN') and config.MAX_MSG_LEN > 0 else None
+    generate_seconds = config.generate_seconds if hasattr(config, 'generate_seconds') else 2.
+    sentence_pool.max_chars = max_chars
+    pool_keyword_replies = config.pool_keyword_replies if hasattr(config, 'pool_keyword_replies') else False
+    try:
+        if text:
+            tokens = await workers.cut(text)
+            chain = partitions.get(find_chat(chat_id), chat_id < 0)
+            pool_chain = chain if chain is not None else model.chain
+            # cutting is not counted, it's bounded by the worker timeout
+            deadline = time.monotonic() + generate_seconds
+            response = ((pooled_response(pool_chain, tokens) if pool_keyword_replies else None)
+                or await workers.respond(text, tokens, chain, max_chars, deadline)
+                or sentence_pool.get(pool_chain)
+                or await workers.generate(chain, max_chars, deadline))
+            if get_user_right(sender_id) >= (USER_RIGHT_LEVEL_NORMAL if chat_id < 0 else USER_RIGHT_LEVEL_TRUSTED):
+                await ingest_text(text, tokens, chat_id, sender_id, mktime(event.message.date.timetuple()))
+        else:
+            chain = partitions.get(find_chat(chat_id), chat_id < 0)
+            response = (sentence_pool.get(chain if chain is not None else model.chain)
+                or await workers.generate(chain, max_chars, time.monotonic() + generate_seconds))
+    except asyncio.TimeoutError:
+        logging.warning(f'reply: timed out in workers, chat: {chat_id}, user: {sender_id}')
+        return
 
     if response:
         if should_always_respond and (random.rand() > (config.always_respond_prob or 0)):
             return
-        if hasattr(config, 'MAX_MSG_LEN') and config.MAX_MSG_LEN > 0:
-            await event.respond(response[:config.MAX_MSG_LEN])
-        else:
-            await event.respond(response)
+        await event.respond(response)
 
-@bot.on(events.NewMessage(incoming=True, pattern=rf'^/erase($|\s|@{escaped_bot_name})'))
+def delete_lines(cursor, lines, user_id=None):
+    # runs in the db writer
+    # return: (corpus_id, corpus_line, corpus_weight) of found lines, number of deleted lines
+    hashes = [content_hash(line) for line in lines]
+    if user_id is None:
+        cursor.execute(f"""
+            SELECT corpus_id, corpus_line, corpus_weight FROM corpus
+            WHERE corpus_hash IN ({','.join('?'*len(hashes))})
+            """, hashes)
+    else:
+        # only search for lines from the user
+        cursor.execute(f"""
+            SELECT corpus_id, corpus_line, corpus_weight FROM corpus
+            WHERE corpus_user = ?
+            AND corpus_hash IN ({','.join('?'*len(hashes))})
+            """, [user_id] + hashes)
+    rst = cursor.fetchall()
+    if not rst:
+        return rst, 0
+    ids = tuple(r[0] for r in rst)
+    cursor.execute(f"""
+        DELETE FROM corpus
+        WHERE corpus_id IN ({','.join('?'*len(ids))})
+        """, ids)
+    return rst, cursor.rowcount
+
+@command('erase')
 async def erase(event):
     chat_id = event.chat_id
     sender_id = event.sender_id
 
-    if not chat_is_allowed(chat_id) or is_banned(sender_id):
-        return
-
     user_right = get_user_right(sender_id)
     is_admin = (user_right >= USER_RIGHT_LEVEL_ADMIN)
     non_admin_notice = (f'\n权限低于 {USER_RIGHT_LEVEL_NAME[USER_RIGHT_LEVEL_ADMIN]} 的用户只能移除来源为自己的句子，'
@@ -849,51 +1184,204 @@ async def erase(event):
             f'如果您已成为特定群的群管，可使用 /reload 指令刷新权限。') if not is_admin else ''
 
     text = await parse(event, cmd='/erase', use_reply=True)
-    lines_to_erase = model.cut_lines(text)
+    lines_to_erase = model.cut_lines(text, await workers.cut(text)) if text else []
     if not text or not lines_to_erase:
         await event.respond('❌ 未在消息中找到要删除的句子。')
         return
 
-    if is_admin:
-        cursor.execute(f"""
-            SELECT corpus_id, corpus_line, corpus_weight FROM corpus
-            WHERE corpus_line IN ({','.join('?'*len(lines_to_erase))})
-            """, lines_to_erase)
-    else:
-        # only search for lines from sender
-        cursor.execute(f"""
-            SELECT corpus_id, corpus_line, corpus_weight FROM corpus
-            WHERE corpus_user = ?
-            AND corpus_line IN ({','.join('?'*len(lines_to_erase))})
-            """, [find_user(sender_id)] + lines_to_erase)
-    rst = cursor.fetchall()
+    user_id = None if is_admin else find_user(sender_id)
+    rst, lines_count = await db.write(delete_lines, lines_to_erase, user_id)
     if not rst:
         await event.respond(f'❌ 未在数据库中找到要删除的句子。' + non_admin_notice)
         return
     [ids, lines, weights] = zip(*rst)
     logging.info(f'erase: {lines}, weight: {weights}')
     erase_weights = tuple(-1.*w for w in weights)
-    cursor.execute(f"""
-        DELETE FROM corpus
-        WHERE corpus_id IN ({','.join('?'*len(ids))})
-        """, ids)
-    model.erase(lines, weight=erase_weights)
-    lines_count = cursor.rowcount
-    conn.commit()
+    with model_seconds.time('erase'):
+        model.erase(lines, weight=erase_weights)
+    wordclouds.clear()
+    partitions.clear()
+    sentence_pool.clear()
 
     await event.respond(f'✅ 已删除 {lines_count} 个句子。' + non_admin_notice)
 
     user_name = get_user_name(sender_id) or sender_id
-    await log_in_chat('erase', fwd_msgs=event.message, lines='\n'.join(lines),
+    log_in_chat('erase', fwd_msgs=event.message, lines='\n'.join(lines),
         linecount=lines_count, username=user_name, userid=sender_id,
         chatid=chat_id, msgid=event.message.id)
 
+def format_stats():
+    chain = model.chain
+    lines = [f'📊 模型：{len(chain.table)} + {len(chain.delta)} 个状态，{len(chain.vocab)} 个词，'
+             f'约 {chain.nbytes() / 2**20:.1f} MB；进程内存 {resident_memory() / 2**20:.1f} MB']
+    for metric in registry.metrics.values():
+        if metric.type == 'histogram' and metric.name.endswith('_seconds'):
+            items = metric.items()
+            if items:
+                lines.append(f'\n{metric.name}')
+            for label_values, (counts, total, count) in items:
+                lines.append(f'{",".join(label_values) or "-"}: {count} 次，平均 {total / count * 1000:.1f} ms，'
+                    f'p50 ≤ {metric.quantile(0.5, *label_values) * 1000:g} ms，'
+                    f'p99 ≤ {metric.quantile(0.99, *label_values) * 1000:g} ms')
+        elif metric.type == 'counter':
+            items = metric.items()
+            if items:
+                lines.append(f'\n{metric.name}')
+            for label_values, value in items:
+                lines.append(f'{",".join(label_values) or "-"}: {value}')
+    return '\n'.join(lines)[:4000]
+
+@command('stats', right=USER_RIGHT_LEVEL_ROOT)
+async def stats(event):
+    await event.respond(format_stats())
+
+compact_lock = asyncio.Lock()
+compact_seconds = registry.histogram('compact_seconds', 'Time of building a compacted chain in a thread',
+    buckets=(1., 5., 10., 30., 60., 120., 300., 600., 1800.))
+
+async def compact_chain():
+    '''
+    Drop dead and unreachable entries of the chain, and prune it to `compact_max_bytes`.
+    The compacted copy is built in a thread from the table, while changes are kept
+    in the delta of the current chain. These are copied to it before it's swapped in.
+    return: stats of MarkovChain.compacted(), None if the chain was replaced meanwhile
+    '''
+    epsilon = config.compact_epsilon if hasattr(config, 'compact_epsilon') else 1e-9
+    max_bytes = config.compact_max_bytes if hasattr(config, 'compact_max_bytes') else 0
+    chain = model.chain
+    loop = asyncio.get_event_loop()
+    # merge in a thread too, the changes made meanwhile stay in delta and are copied
+    chain.start_merge()
+    while chain.merging is not None:
+        merging = chain.merging
+        await loop.run_in_executor(None, merging.thread.join)
+        if chain.merging is merging:
+            chain.finish_merge()
+    chain.frozen = True
+    try:
+        with compact_seconds.time():
+            compacted, stats = await loop.run_in_executor(None, chain.compacted, epsilon, max_bytes)
+    finally:
+        chain.frozen = False
+    if model.chain is not chain:
+        # replaced by /reprocessraw
+        return None
+    with model_seconds.time('compact'):
+        compacted.copy_delta(chain, epsilon)
+        model.replace_chain(compacted)
+    logging.info(f'compact: {stats}')
+    return stats
+
+def format_compact_stats(stats):
+    (states, new_states), (transitions, new_transitions), (tokens, new_tokens), (nbytes, new_nbytes) = (
+        stats['states'], stats['transitions'], stats['tokens'], stats['bytes'])
+    return (f'状态 {states} → {new_states}，转移 {transitions} → {new_transitions}，'
+            f'词 {tokens} → {new_tokens}，释放约 {(nbytes - new_nbytes) / 2**20:.1f} MB')
+
+@command('compact', right=USER_RIGHT_LEVEL_ROOT)
+async def compact(event):
+    if compact_lock.locked():
+        await event.respond('❌ 压缩正在进行中。')
+        return
+    msg = await event.respond('🕙 正在压缩模型……')
+    async with compact_lock:
+        stats = await compact_chain()
+    if stats is None:
+        await msg.edit('❌ 模型在压缩期间被重建，未进行替换。')
+        return
+    await msg.edit('✅ 已压缩模型：' + format_compact_stats(stats))
+
+async def compact_periodically():
+    # every `compact_interval` seconds, read again after each run
+    while True:
+        interval = config.compact_interval if hasattr(config, 'compact_interval') else 0
+        if interval <= 0:
+            return
+        await asyncio.sleep(interval)
+        try:
+            async with compact_lock:
+                stats = await compact_chain()
+            if stats:
+                log_in_chat('compact', **stats)
+        except Exception:
+            logging.exception('Failed to compact the chain')
+
+handler_seconds = registry.histogram('handler_seconds', 'Time of message handlers', ['handler'])
+handler_errors = registry.counter('handler_errors_total', 'Exceptions in message handlers', ['handler'])
+
+def route(event):
+    # return: handler of the message, None to ignore it
+    text = event.raw_text
+    if not text.startswith('/'):
+        return reply
+
+    # /command or /command@bot_name, followed by a whitespace or the end
+    name, _, mention = text.split(None, 1)[0][1:].partition('@')
+    if mention and mention.lower() != bot_name.lower():
+        # for other bots
+        return None
+    entry = commands.get(name)
+    if not entry:
+        return reply
+    func, right, groups_only = entry
+    if groups_only and event.chat_id > 0:
+        return None
+    if right is not None and get_user_right(event.sender_id) < right:
+        return partial(respond_right_required, right=right)
+    return func
+
+@bot.on(events.NewMessage(incoming=True))
+async def dispatch(event):
+    # the only handler: commands are looked up in `commands`, other messages are replied
+    chat_id = event.chat_id
+    sender_id = event.sender_id
+    own_messages.observe(chat_id, event.id)
+
+    if not chat_is_allowed(chat_id) or is_banned(sender_id):
+        return
+    event = Context(event)
+    func = route(event)
+    if func is None:
+        return
+    name = func.func.__name__ if isinstance(func, partial) else func.__name__
+    try:
+        with handler_seconds.time(name):
+            await func(event)
+    except Exception:
+        handler_errors.inc(name)
+        raise
+
+# tokenizers load in the background while we are serving, a fallback is used until then
+## with worker processes, the tokenizer of the main process is not used for cutting
+if tokenizer_warm_up and not workers.processes:
+    model.tokenizer.warm_up()
+
+# Prometheus metrics, for local scraping only by default
+metrics_port = config.metrics_port if hasattr(config, 'metrics_port') else 0
+if metrics_port:
+    metrics_host = config.metrics_host if hasattr(config, 'metrics_host') else '127.0.0.1'
+    bot.loop.run_until_complete(serve_metrics(metrics_host, metrics_port))
+    logging.info(f'Serving metrics on http://{metrics_host}:{metrics_port}/metrics')
+
+# dead entries left by erasing are dropped from the chain in the background
+bot.loop.create_task(compact_periodically())
 
 logging.info('Running Telegram bot...')
 with bot:
     bot.run_until_disconnected()
+    # even with nothing pending, a flush may be in progress
+    if chat_log.task is not None:
+        logging.info('Sending pending logs...')
+        try:
+            bot.loop.run_until_complete(bot.connect())
+            bot.loop.run_until_complete(chat_log.close())
+        except Exception:
+            logging.exception('Failed to send pending logs')
     logging.info('Disconnected from Telegram server. Exporting corpora...')
-    #model.save('./corpora.json')
-    conn.close()
+    workers.shutdown()
+    # commit pending writes before the snapshot
+    db.close()
+    if snapshot_path:
+        model.save_snapshot(snapshot_path, config.dbfile)
     logging.info('Corpora saved. Exiting...')
     exit(0)
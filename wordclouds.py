@@ -0,0 +1,115 @@
+import re
+import asyncio
+from collections import Counter, OrderedDict, deque
+
+word_re = re.compile(r'\w')
+
+class WordClouds:
+    '''
+    Word clouds of the recent lines of (user, chat) pairs.
+
+    Token counts of the last `window` lines are kept for the `max_pairs` most
+    recently used pairs, and updated by add() as lines are stored. Images are
+    rendered from the counts by `render(frequencies)` in worker threads. The last
+    `max_images` of them are cached by the version of the counts they show, and
+    concurrent requests for the same image share one rendering.
+    '''
+    def __init__(self, workers, render, stopwords=(), window=500, max_words=200, max_pairs=1000, max_images=32):
+        self.workers = workers
+        self.render = render
+        self.stopwords = set(word.lower() for word in stopwords)
+        self.window = window
+        self.max_words = max_words
+        self.max_pairs = max_pairs
+        self.max_images = max_images
+        # key: [tokens of recent lines, counts, version]
+        self.counts = OrderedDict()
+        # (key, version): png
+        self.images = OrderedDict()
+        self.rendering = {}
+        # versions are never reused, even after clear()
+        self.version = 0
+
+    def tokens(self, line):
+        # like WordCloud.generate, skip single characters, punctuation and stopwords
+        return [t for t in line.split(' ')
+                if len(t) > 1 and word_re.search(t) and t.lower() not in self.stopwords]
+
+    def _next_version(self):
+        self.version += 1
+        return self.version
+
+    def loaded(self, key):
+        return key in self.counts
+
+    def load(self, key, lines):
+        # lines: recent lines of the pair, oldest first
+        recent = deque((self.tokens(line) for line in lines), maxlen=self.window)
+        counter = Counter()
+        for tokens in recent:
+            counter.update(tokens)
+        self.counts[key] = [recent, counter, self._next_version()]
+        while len(self.counts) > self.max_pairs:
+            self.counts.popitem(last=False)
+
+    def add(self, key, lines):
+        entry = self.counts.get(key)
+        if entry is None:
+            # loaded from db when needed
+            return
+        recent, counter, _ = entry
+        for line in lines:
+            if len(recent) == self.window:
+                for token in recent[0]:
+                    counter[token] -= 1
+                    if counter[token] <= 0:
+                        del counter[token]
+            tokens = self.tokens(line)
+            recent.append(tokens)
+            counter.update(tokens)
+        entry[2] = self._next_version()
+
+    def clear(self):
+        # lines have been changed or erased, counts are loaded again when needed
+        self.counts.clear()
+
+    def line_count(self, key):
+        entry = self.counts.get(key)
+        return len(entry[0]) if entry else 0
+
+    def cached_image(self, key):
+        entry = self.counts.get(key)
+        if entry is None:
+            return None
+        image = self.images.get((key, entry[2]))
+        if image is not None:
+            self.images.move_to_end((key, entry[2]))
+        return image
+
+    async def image(self, key):
+        # return: png of the word cloud, None if there are no words or the counts are not loaded
+        entry = self.counts.get(key)
+        if entry is None:
+            return None
+        self.counts.move_to_end(key)
+        recent, counter, version = entry
+        image_key = (key, version)
+        if image_key in self.images:
+            self.images.move_to_end(image_key)
+            return self.images[image_key]
+        if image_key not in self.rendering:
+            frequencies = dict((word, count) for word, count in counter.most_common(self.max_words) if count > 0)
+            if not frequencies:
+                return None
+            self.rendering[image_key] = asyncio.ensure_future(self._render(image_key, frequencies))
+        return await asyncio.shield(self.rendering[image_key])
+
+    async def _render(self, image_key, frequencies):
+        try:
+            image = await self.workers.run(self.render, frequencies)
+        finally:
+            del self.rendering[image_key]
+        self.images[image_key] = image
+        while len(self.images) > self.max_images:
+            self.images.popitem(last=False)
+        return image
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import multiprocessing
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from markov import Tokenizer
+from metrics import registry
+
+worker_seconds = registry.histogram('worker_seconds', 'Time of worker jobs, including waiting for a slot', ['job'])
+worker_timeouts = registry.counter('worker_timeouts_total', 'Worker jobs timed out', ['job'])
+
+# tokenizer of a worker process
+_tokenizer = None
+_dict_version = 0
+# texts of a batch are cut in threads, so that the tokenizer batches their CkipTagger sentences
+_threads = None
+
+def _init_process(tokenizer_options, warm_up, threads=1):
+    global _tokenizer, _threads
+    # forked with the metrics of the main process
+    registry.reset()
+    _tokenizer = Tokenizer(**tokenizer_options)
+    if warm_up:
+        _tokenizer.warm_up()
+    if threads > 1:
+        _threads = ThreadPoolExecutor(max_workers=threads)
+
+def _cut(texts, dict_version):
+    global _dict_version
+    # the user dictionaries have been changed by the main process
+    if dict_version != _dict_version:
+        _tokenizer.load_dicts(dict_version)
+        _dict_version = dict_version
+    if _threads is not None and len(texts) > 1:
+        return list(_threads.map(_tokenizer.cut, texts))
+    return [_tokenizer.cut(text) for text in texts]
+
+def _cut_with_metrics(texts, dict_version):
+    # return: tokens, metrics updated since the last call, to be merged in the main process
+    return _cut(texts, dict_version), registry.collect()
+
+class WorkerPool:
+    '''
+    Runs CPU heavy work off the event loop. Tokenization goes to worker processes
+    (or threads with the model's tokenizer, if `processes` is 0), other jobs go
+    to threads. At most `max_pending` jobs wait or run at the same time, and
+    a job not done within `timeout` seconds raises asyncio.TimeoutError.
+
+    Worker processes are forked when the pool is created, so create the pool
+    before loading the model in the main process. If `warm_up` is set, they load
+    their tokenizers in the background right away.
+
+    Concurrent cut() calls within `ckip_batch_wait` seconds of the tokenizer
+    options (up to `ckip_batch_size` texts) are sent together as one cut_many(),
+    whose texts are cut in threads, so that CkipTagger gets their sentences in
+    one batch with worker processes too.
+    '''
+    def __init__(self, processes=0, threads=4, max_pending=64, timeout=30., tokenizer_options=None, warm_up=True):
+        tokenizer_options = tokenizer_options or {}
+        self.timeout = timeout
+        self.model = None
+        self.threads = ThreadPoolExecutor(max_workers=threads)
+        self.processes = None
+        self.batch_size = tokenizer_options.get('ckip_batch_size', 64)
+        self.batch_wait = tokenizer_options.get('ckip_batch_wait', 0.005)
+        if processes > 0:
+            self.processes = multiprocessing.get_context('fork').Pool(
+                processes, _init_process, (tokenizer_options, warm_up, self.batch_size))
+        # (text, future) of cut() calls waiting to be sent, and the timer sending them
+        self.cuts = []
+        self.cuts_timer = None
+        self.slots = asyncio.Semaphore(max_pending)
+        # jobs waiting or running, for background work to wait until the pool is idle
+        self.running = 0
+
+    async def _submit(self, start, timeout=None, job='run'):
+        # start: function returning a future of the job
+        loop = asyncio.get_event_loop()
+        timeout = timeout or self.timeout
+        deadline = loop.time() + timeout
+        self.running += 1
+        try:
+            with worker_seconds.time(job):
+                try:
+                    await asyncio.wait_for(self.slots.acquire(), timeout)
+                except asyncio.TimeoutError:
+                    worker_timeouts.inc(job)
+                    raise
+                try:
+                    return await asyncio.wait_for(start(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    worker_timeouts.inc(job)
+                    raise
+                finally:
+                    self.slots.release()
+        finally:
+            self.running -= 1
+
+    def _apply(self, func, *args):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        def set_result(rst):
+            if not future.done():
+                future.set_result(rst)
+        def set_exception(e):
+            if not future.done():
+                future.set_exception(e)
+        self.processes.apply_async(func, args,
+            callback=lambda rst: loop.call_soon_threadsafe(set_result, rst),
+            error_callback=lambda e: loop.call_soon_threadsafe(set_exception, e))
+        return future
+
+    async def run(self, func, *args, timeout=None):
+        # run func(*args) in a thread
+        loop = asyncio.get_event_loop()
+        return await self._submit(lambda: loop.run_in_executor(self.threads, partial(func, *args)), timeout,
+            getattr(func, '__name__', 'run'))
+
+    async def cut_many(self, texts, timeout=None):
+        texts = list(texts)
+        if self.processes is None:
+            loop = asyncio.get_event_loop()
+            return await self._submit(lambda: asyncio.gather(*(loop.run_in_executor(self.threads, self.model.cut, text)
+                for text in texts)), timeout, 'cut')
+        dict_version = self.model.tokenizer.dict_version
+        tokens, updates = await self._submit(lambda: self._apply(_cut_with_metrics, texts, dict_version), timeout, 'cut')
+        registry.merge(updates)
+        return tokens
+
+    async def cut(self, text, timeout=None):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.cuts.append((text, future))
+        if len(self.cuts) >= self.batch_size:
+            self._send_cuts()
+        elif self.cuts_timer is None:
+            self.cuts_timer = loop.call_later(self.batch_wait, self._send_cuts)
+        if timeout is None:
+            return await future
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+
+    def _send_cuts(self):
+        if self.cuts_timer is not None:
+            self.cuts_timer.cancel()
+            self.cuts_timer = None
+        cuts, self.cuts = self.cuts, []
+        asyncio.ensure_future(self._cut_batch(cuts))
+
+    async def _cut_batch(self, cuts):
+        try:
+            rst = await self.cut_many([text for text, _ in cuts])
+        except Exception as e:
+            for _, future in cuts:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), tokens in zip(cuts, rst):
+            if not future.done():
+                future.set_result(tokens)
+
+    async def respond(self, text, tokens=None, chain=None, max_chars=None, deadline=None, timeout=None):
+        return await self.run(self.model.respond, text, tokens, chain, max_chars, deadline, timeout=timeout)
+
+    async def generate(self, chain=None, max_chars=None, deadline=None, timeout=None):
+        return await self.run(self.model.generate, chain, max_chars, deadline, timeout=timeout)
+
+    async def generate_many(self, count, chain=None, max_chars=None, deadline=None, timeout=None):
+        return await self.run(self.model.generate_many, count, chain, max_chars, deadline, timeout=timeout)
+
+    def shutdown(self):
+        logging.info('Shutting down workers...')
+        if self.processes is not None:
+            self.processes.close()
+            self.processes.join()
+        self.threads.shutdown(wait=True)